@@ -3,13 +3,36 @@ The flask application for our program
 """
 # importing required python libraries
 import json
-from datetime import datetime, timedelta
+import csv
+import codecs
+import io
+import re
+from datetime import datetime, timedelta, timezone
 import base64
 import hashlib
+import hmac
+import time
 import uuid
 import random
-from flask import Flask, jsonify, request, send_file, redirect, url_for, session
+import threading
+from collections import OrderedDict
+import click
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from flask import (
+    Flask,
+    Response,
+    g,
+    has_request_context,
+    jsonify,
+    request,
+    send_file,
+    redirect,
+    url_for,
+    session,
+    stream_with_context,
+)
 from flask_mongoengine import MongoEngine
+from mongoengine.errors import NotUniqueError
 from flask_cors import CORS, cross_origin
 from dotenv import load_dotenv
 
@@ -19,28 +42,688 @@ from fake_useragent import UserAgent
 import yaml
 
 import requests
+from bson import ObjectId
+from pymongo import ReplaceOne, ReturnDocument, UpdateOne, monitoring
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
 from authlib.integrations.flask_client import OAuth
 from authlib.common.security import generate_token
 
-
-existing_endpoints = ["/applications", "/resume"]
+from llm_client import (
+    DEFAULT_MODEL,
+    DEFAULT_URL,
+    IncrementalJSONParser,
+    LLMClient,
+    LLMError,
+    SingleFlight,
+)
+
+
+existing_endpoints = [
+    "/applications",
+    "/applications/import",
+    "/applications/export",
+    "/applications/stats",
+    "/applications/search",
+    "/analyses/export",
+    "/search/cache",
+    "/resume",
+]
 
 user_agent = UserAgent()
 
-# TODO: Remove from here
-def get_ai_job_recommendations(skills, job_levels, locations):
+
+class QueryCounter(monitoring.CommandListener):
     """
-    Get AI-powered job recommendations using a structured prompt
+    Counts the database round-trips made while handling the current request
+    in g.query_count
+    """
+
+    def started(self, event):
+        if has_request_context():
+            g.query_count = g.get("query_count", 0) + 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+# listeners only apply to clients created afterwards, so register before connecting
+monitoring.register(QueryCounter())
+
+
+class TokenCache:
+    """
+    Bounded, TTL-aware cache of validated authorization tokens so that the
+    middleware does not have to load the user on every authorized request
+    """
+
+    def __init__(self, max_size=10000, ttl=60):
+        """
+        :param max_size: maximum number of tokens kept in memory
+        :param ttl: seconds a validated token is trusted before re-checking the database
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, token):
+        """
+        Returns the user id cached for the token, or None if missing or expired
+
+        :param token: authorization token
+        :return: user id or None
+        """
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None:
+                self.misses += 1
+                return None
+            user_id, valid_until = entry
+            if datetime.utcnow() > valid_until:
+                del self._entries[token]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(token)
+            self.hits += 1
+            return user_id
+
+    def set(self, token, user_id, expiry):
+        """
+        Caches a validated token until its expiry or the cache ttl, whichever is first
+
+        :param token: authorization token
+        :param user_id: id of the user owning the token
+        :param expiry: UTC datetime at which the token expires
+        """
+        valid_until = min(expiry, datetime.utcnow() + timedelta(seconds=self.ttl))
+        with self._lock:
+            self._entries[token] = (user_id, valid_until)
+            self._entries.move_to_end(token)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, token):
+        """
+        Removes the token from the cache
+
+        :param token: authorization token
+        """
+        with self._lock:
+            self._entries.pop(token, None)
+
+    def clear(self):
+        """
+        Removes every token from the cache and resets the counters
+        """
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """
+        Returns the cache size and hit/miss counters
+
+        :return: dictionary with cache statistics
+        """
+        with self._lock:
+            return {"size": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+class TokenDenyList:
+    """
+    Small deny-list of revoked signed tokens. Revocations are kept in memory and,
+    when shared, persisted to the RevokedTokens collection and periodically
+    reloaded in the background so that other workers pick them up
+    """
+
+    def __init__(self, shared=True, refresh_interval=30):
+        """
+        :param shared: whether revocations are persisted to and reloaded from the database
+        :param refresh_interval: seconds between reloads of the persisted revocations
+        """
+        self.shared = shared
+        self.refresh_interval = refresh_interval
+        self._revoked = {}
+        self._lock = threading.Lock()
+        self._last_refresh = 0
+        self._refreshing = False
+
+    def add(self, signature, expires):
+        """
+        Revokes the token with the given signature until it expires
+
+        :param signature: signature part of the token
+        :param expires: UNIX timestamp at which the token expires anyway
+        """
+        with self._lock:
+            self._revoked[signature] = expires
+        if self.shared:
+            RevokedTokens.objects(signature=signature).update_one(
+                upsert=True, set__expiry=datetime.utcfromtimestamp(expires)
+            )
+
+    def __contains__(self, signature):
+        if self.shared and time.time() - self._last_refresh > self.refresh_interval:
+            self._refresh_in_background()
+        with self._lock:
+            expires = self._revoked.get(signature)
+            if expires is not None and expires < time.time():
+                del self._revoked[signature]
+                return False
+            return expires is not None
+
+    def refresh(self):
+        """
+        Reloads the revocations persisted by every worker
+        """
+        revoked = {
+            entry.signature: entry.expiry.replace(tzinfo=timezone.utc).timestamp()
+            for entry in RevokedTokens.objects(expiry__gt=datetime.utcnow())
+        }
+        with self._lock:
+            self._revoked.update(revoked)
+            now = time.time()
+            for signature in [s for s, e in self._revoked.items() if e < now]:
+                del self._revoked[signature]
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+            self._last_refresh = time.time()
+
+        def run():
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f"Could not refresh token deny-list: {str(e)}")
+            finally:
+                self._refreshing = False
+
+        threading.Thread(target=run, daemon=True).start()
+
+
+class SignedTokens:
+    """
+    Issues and verifies stateless session tokens of the form
+    <user id>.<expiry timestamp>.<HMAC signature>, which are verified without
+    a database lookup
     """
-    try:
-        print("running!!!")
-        # Format the user preferences for the prompt
-        skills_str = ", ".join([skill["value"] for skill in skills])
-        levels_str = ", ".join([level["value"] for level in job_levels])
-        locations_str = ", ".join([loc["value"] for loc in locations])
 
-        # Create a structured prompt for the AI
-        prompt = f"""
+    def __init__(self, secret_key, deny_list, lifetime=timedelta(days=1)):
+        """
+        :param secret_key: key used to sign the tokens
+        :param deny_list: TokenDenyList holding revoked tokens
+        :param lifetime: how long issued tokens stay valid
+        """
+        self._key = secret_key.encode()
+        self.deny_list = deny_list
+        self.lifetime = lifetime
+
+    def _sign(self, payload):
+        digest = hmac.new(self._key, payload.encode(), hashlib.sha256).digest()
+        return base64.urlsafe_b64encode(digest).rstrip(b"=").decode()
+
+    def issue(self, user_id):
+        """
+        Issues a signed token for the user
+
+        :param user_id: user id of the token owner
+        :return: token and its expiry formatted for the client
+        """
+        expires = int(time.time() + self.lifetime.total_seconds())
+        payload = f"{user_id}.{expires}"
+        expiry_str = datetime.fromtimestamp(expires).strftime("%m/%d/%Y, %H:%M:%S")
+        return f"{payload}.{self._sign(payload)}", expiry_str
+
+    def verify(self, token):
+        """
+        Verifies the signature, expiry and revocation status of the token
+
+        :param token: token to be verified
+        :return: user id of the token owner, or None if the token is not valid
+        """
+        parts = token.split(".")
+        if len(parts) != 3 or not parts[1].isdigit():
+            return None
+        user_id, expires, signature = parts
+        if not hmac.compare_digest(signature, self._sign(f"{user_id}.{expires}")):
+            return None
+        if int(expires) < time.time() or signature in self.deny_list:
+            return None
+        return user_id
+
+    def revoke(self, token):
+        """
+        Adds a valid token to the deny-list
+
+        :param token: token to be revoked
+        """
+        if self.verify(token) is not None:
+            _, expires, signature = token.split(".")
+            self.deny_list.add(signature, int(expires))
+
+
+class PasswordHasher:
+    """
+    Hashes and verifies passwords with scrypt on a small pool of worker threads.
+    scrypt releases the GIL, so request threads keep running while a hash is
+    computed, and the pool bounds the CPU and memory spent on concurrent logins.
+    Passwords stored as plain MD5 digests by earlier versions are still accepted
+    and reported by needs_rehash
+    """
+
+    def __init__(self, n=2 ** 14, r=8, p=1, workers=2, max_pending=64, timeout=10):
+        """
+        :param n: scrypt CPU/memory cost, a power of two
+        :param r: scrypt block size
+        :param p: scrypt parallelization
+        :param workers: number of hashes computed at the same time
+        :param max_pending: number of hashes allowed to wait for a worker
+        :param timeout: seconds to wait for a hash before giving up
+        """
+        self.n, self.r, self.p = n, r, p
+        self.timeout = timeout
+        self._pool = ThreadPoolExecutor(max_workers=workers,
+                                        thread_name_prefix="password-hasher")
+        self._slots = threading.BoundedSemaphore(workers + max_pending)
+
+    def hash(self, password):
+        """
+        Hashes a password with a new salt
+
+        :param password: password in clear text
+        :return: string holding the parameters, salt and hash
+        """
+        salt = os.urandom(16)
+        digest = self._run(password, salt, self.n, self.r, self.p)
+        return "$".join([
+            "scrypt", str(self.n), str(self.r), str(self.p),
+            base64.b64encode(salt).decode(), base64.b64encode(digest).decode(),
+        ])
+
+    def verify(self, password, stored):
+        """
+        Checks a password against a stored hash
+
+        :param password: password in clear text
+        :param stored: hash produced by hash(), or a legacy MD5 hex digest
+        :return: True if the password matches
+        """
+        if not stored:
+            return False
+        if not stored.startswith("scrypt$"):
+            digest = hashlib.md5(password.encode()).hexdigest()
+            return hmac.compare_digest(digest, stored)
+        _, n, r, p, salt, expected = stored.split("$")
+        digest = self._run(password, base64.b64decode(salt), int(n), int(r), int(p))
+        return hmac.compare_digest(digest, base64.b64decode(expected))
+
+    def needs_rehash(self, stored):
+        """
+        Tells whether a stored hash is MD5 or uses other parameters than the configured ones
+
+        :param stored: stored password hash
+        :return: True if the password should be hashed again
+        """
+        return not stored.startswith(f"scrypt${self.n}${self.r}${self.p}$")
+
+    def _run(self, password, salt, n, r, p):
+        # TimeoutError tells the handlers that too many logins are queued
+        if not self._slots.acquire(timeout=self.timeout):
+            raise TimeoutError("Too many password hashes pending")
+        try:
+            future = self._pool.submit(
+                hashlib.scrypt, password.encode(), salt=salt, n=n, r=r, p=p,
+                maxmem=256 * n * r * p, dklen=32,
+            )
+        except Exception:
+            self._slots.release()
+            raise
+        # the slot is held until the hash is done or cancelled, so abandoned
+        # hashes still count against max_pending
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            # before Python 3.11 this is not the builtin TimeoutError
+            future.cancel()
+            raise TimeoutError("Password hash took too long")
+
+
+class InsightCache:
+    """
+    Two-tier cache of parsed /search insights. A small in-process LRU answers
+    repeated searches without I/O and the CachedInsights collection shares the
+    answers between workers and restarts until the TTL removes them. Entries are
+    keyed by the normalized keywords, the model and the prompt version, so that
+    changing either of the latter two never serves answers of the old prompt
+    """
+
+    def __init__(self, max_size=1000, ttl=7 * 86400, memory_ttl=300, shared=True):
+        """
+        :param max_size: maximum number of insights kept in memory
+        :param ttl: seconds an answer is served before asking the model again
+        :param memory_ttl: seconds an answer stays in memory, which bounds how long
+            other workers keep serving invalidated entries
+        :param shared: whether answers are stored in the database
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.memory_ttl = min(memory_ttl, ttl)
+        self.shared = shared
+        self.memory_hits = 0
+        self.database_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def normalize(keywords):
+        """
+        Normalizes search keywords, ignoring case and extra whitespace
+
+        :param keywords: keywords as typed by the user
+        :return: normalized keywords
+        """
+        return " ".join(keywords.lower().split())
+
+    def key(self, keywords, model, prompt_version):
+        """
+        Returns the cache key of a search
+
+        :param keywords: keywords as typed by the user
+        :param model: model answering the search
+        :param prompt_version: version of the prompt sent to the model
+        :return: cache key
+        """
+        return f"{prompt_version}:{model}:{self.normalize(keywords)}"
+
+    def get(self, keywords, model, prompt_version):
+        """
+        Returns the cached insights of a search, or None
+
+        :param keywords: keywords as typed by the user
+        :param model: model answering the search
+        :param prompt_version: version of the prompt sent to the model
+        :return: insights dictionary or None
+        """
+        key = self.key(keywords, model, prompt_version)
+        now = datetime.utcnow()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > now:
+                self._entries.move_to_end(key)
+                self.memory_hits += 1
+                return entry[0]
+            self._entries.pop(key, None)
+        document = None
+        if self.shared:
+            try:
+                document = CachedInsights._get_collection().find_one(
+                    {"_id": key, "expiresAt": {"$gt": now}}, {"insights": 1, "expiresAt": 1})
+            except Exception as e:
+                print(f"Could not read cached insights: {str(e)}")
+        with self._lock:
+            if document is None:
+                self.misses += 1
+                return None
+            self.database_hits += 1
+        self._remember(key, keywords, document["insights"], document["expiresAt"])
+        return document["insights"]
+
+    def set(self, keywords, model, prompt_version, insights):
+        """
+        Caches the insights of a search
+
+        :param keywords: keywords as typed by the user
+        :param model: model answering the search
+        :param prompt_version: version of the prompt sent to the model
+        :param insights: insights dictionary
+        """
+        key = self.key(keywords, model, prompt_version)
+        now = datetime.utcnow()
+        expires_at = now + timedelta(seconds=self.ttl)
+        self._remember(key, keywords, insights, expires_at)
+        if self.shared:
+            try:
+                CachedInsights._get_collection().replace_one({"_id": key}, {
+                    "keywords": self.normalize(keywords),
+                    "model": model,
+                    "promptVersion": prompt_version,
+                    "insights": insights,
+                    "createdAt": now,
+                    "expiresAt": expires_at,
+                }, upsert=True)
+            except Exception as e:
+                print(f"Could not store cached insights: {str(e)}")
+
+    def invalidate(self, keywords=None):
+        """
+        Removes the cached insights of the keywords for every model and prompt
+        version, or every cached insight when no keywords are given
+
+        :param keywords: keywords as typed by the user, or None
+        :return: number of entries removed from the database
+        """
+        normalized = None if keywords is None else self.normalize(keywords)
+        with self._lock:
+            for key in [k for k, entry in self._entries.items()
+                        if normalized is None or entry[2] == normalized]:
+                del self._entries[key]
+        if not self.shared:
+            return 0
+        query = {} if keywords is None else {"keywords": self.normalize(keywords)}
+        return CachedInsights._get_collection().delete_many(query).deleted_count
+
+    def stats(self):
+        """
+        Returns the cache size, hit/miss counters and hit ratio
+
+        :return: dictionary with cache statistics
+        """
+        with self._lock:
+            lookups = self.memory_hits + self.database_hits + self.misses
+            return {
+                "size": len(self._entries),
+                "memoryHits": self.memory_hits,
+                "databaseHits": self.database_hits,
+                "misses": self.misses,
+                "hitRatio": (self.memory_hits + self.database_hits) / lookups if lookups else 0.0,
+            }
+
+    def _remember(self, key, keywords, insights, expires_at):
+        valid_until = min(expires_at, datetime.utcnow() + timedelta(seconds=self.memory_ttl))
+        with self._lock:
+            # the keywords are kept apart from the key, which may contain ":" anywhere
+            self._entries[key] = (insights, valid_until, self.normalize(keywords))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+
+# bump when a /search prompt changes so that cached answers are not reused
+SEARCH_PROMPT_VERSION = "search-1"
+SEARCH_JOBS_PROMPT_VERSION = "search-jobs-1"
+
+
+class MongoFlightStore:
+    """
+    Cross-worker store for SingleFlight. The worker that inserts the flight
+    document first makes the call and publishes its result in the document;
+    the other workers poll the document until the result is there
+    """
+
+    def __init__(self, lease=90, retention=10, poll_interval=0.1):
+        """
+        :param lease: seconds after which an unfinished flight may be taken over
+        :param retention: seconds a published result is kept for waiting workers
+        :param poll_interval: seconds between two polls of a waiting worker
+        """
+        self.lease = lease
+        self.retention = retention
+        self.poll_interval = poll_interval
+
+    def claim(self, key):
+        """
+        Claims a flight for this worker
+
+        :param key: flight key
+        :return: True if this worker has to make the call
+        """
+        now = datetime.utcnow()
+        collection = CompletionFlights._get_collection()
+        try:
+            collection.insert_one({"_id": key, "expiresAt": now + timedelta(seconds=self.lease)})
+            return True
+        except DuplicateKeyError:
+            # the TTL monitor runs once a minute, so take over abandoned flights
+            return collection.find_one_and_update(
+                {"_id": key, "expiresAt": {"$lt": now}},
+                {"$set": {"expiresAt": now + timedelta(seconds=self.lease)},
+                 "$unset": {"result": "", "error": ""}},
+            ) is not None
+
+    def wait(self, key, timeout):
+        """
+        Waits for the result of a flight claimed by another worker
+
+        :param key: flight key
+        :param timeout: seconds to wait
+        :return: whether the flight finished, its result and its error
+        """
+        collection = CompletionFlights._get_collection()
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            flight = collection.find_one({"_id": key})
+            if flight is None or flight["expiresAt"] < datetime.utcnow():
+                return False, None, None
+            if "result" in flight or "error" in flight:
+                return True, flight.get("result"), flight.get("error")
+            time.sleep(self.poll_interval)
+        return False, None, None
+
+    def publish(self, key, result=None, error=None):
+        """
+        Publishes the outcome of a flight to the waiting workers
+
+        :param key: flight key
+        :param result: result of the call
+        :param error: error message if the call failed
+        """
+        outcome = {"error": error} if error is not None else {"result": result}
+        expires_at = datetime.utcnow() + timedelta(seconds=self.retention)
+        CompletionFlights._get_collection().update_one(
+            {"_id": key}, {"$set": {**outcome, "expiresAt": expires_at}})
+
+
+class OIDCMetadataCache:
+    """
+    Cache of an OpenID provider's discovery document and signing keys. Entries
+    older than refresh_interval are reloaded in the background while the cached
+    copy keeps being served; entries older than ttl are reloaded before use
+    """
+
+    def __init__(self, metadata_url, ttl=86400, refresh_interval=3600, timeout=10):
+        """
+        :param metadata_url: URL of the provider's openid-configuration document
+        :param ttl: seconds after which the cached metadata is no longer used
+        :param refresh_interval: seconds after which the metadata is reloaded in the background
+        :param timeout: seconds to wait for the provider
+        """
+        self.metadata_url = metadata_url
+        self.ttl = ttl
+        self.refresh_interval = refresh_interval
+        self.timeout = timeout
+        self._metadata = None
+        self._lock = threading.Lock()
+        self._refreshing = False
+
+    def get(self):
+        """
+        Returns the discovery document with the key set under "jwks"
+
+        :return: dictionary of provider metadata
+        """
+        metadata = self._metadata
+        age = time.time() - metadata["_loaded_at"] if metadata else None
+        if age is None or age > self.ttl:
+            return self.refresh()
+        if age > self.refresh_interval:
+            self._refresh_in_background()
+        return metadata
+
+    def refresh(self):
+        """
+        Reloads the discovery document and the key set it points to
+
+        :return: dictionary of provider metadata
+        """
+        response = requests.get(self.metadata_url, timeout=self.timeout)
+        response.raise_for_status()
+        metadata = response.json()
+        response = requests.get(metadata["jwks_uri"], timeout=self.timeout)
+        response.raise_for_status()
+        metadata["jwks"] = response.json()
+        metadata["_loaded_at"] = time.time()
+        self._metadata = metadata
+        return metadata
+
+    def apply(self, client):
+        """
+        Hands the cached metadata to an Authlib client, which then neither
+        fetches the discovery document nor the keys itself
+
+        :param client: registered Authlib OAuth client
+        :return: the client
+        """
+        metadata = self.get()
+        # a client that force-reloaded its keys for an unknown kid keeps them
+        # until this cache has newer metadata
+        if client.server_metadata.get("_loaded_at") != metadata["_loaded_at"]:
+            client.server_metadata.update(metadata)
+        return client
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def run():
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f"Could not refresh OpenID metadata: {str(e)}")
+            finally:
+                self._refreshing = False
+
+        threading.Thread(target=run, daemon=True).start()
+
+
+def job_recommendation_prompt(skills, job_levels, locations):
+    """
+    Builds the system message and the prompt asking for job recommendations
+
+    :param skills: skills of the user
+    :param job_levels: experience levels of the user
+    :param locations: preferred locations of the user
+    :return: system message and prompt
+    """
+    # Format the user preferences for the prompt
+    skills_str = ", ".join([skill["value"] for skill in skills])
+    levels_str = ", ".join([level["value"] for level in job_levels])
+    locations_str = ", ".join([loc["value"] for loc in locations])
+
+    # Create a structured prompt for the AI
+    prompt = f"""
         Create 5 realistic job postings as a JSON array. Each job should be a JSON object with these exact keys:
         "Job Title", "Company Name", "Location", "Brief Job Description", "Required Skills", "Experience Level", "application URL"
 
@@ -51,88 +734,301 @@ def get_ai_job_recommendations(skills, job_levels, locations):
 
         Ensure the response is valid JSON format and each job matches the candidate's skills and experience level.
         """
+    system = "You are a job matching assistant that creates realistic job recommendations. Always respond with valid JSON."
+    return system, prompt
 
-        headers = {
-            "Authorization": f"Bearer {os.getenv('OPENAI_API_KEY')}",
-            "Content-Type": "application/json"
-        }
-         
-        data = {
-            "model": "gpt-3.5-turbo",
-            "messages": [
-                {
-                    "role": "system", 
-                    "content": "You are a job matching assistant that creates realistic job recommendations. Always respond with valid JSON."
-                },
-                {"role": "user", "content": prompt}
-            ],
-            "temperature": 0.7,
-            "response_format": { "type": "json_object" }  # Force JSON response
-        }
 
-        print("Sending request to OpenAI API...")
-        response = requests.post(
-            "https://api.openai.com/v1/chat/completions",
-            headers=headers,
-            json=data
-        )
+def format_job(job):
+    """
+    Converts a job generated by the model to the format of the application
 
-        print(f"API Response Status: {response.status_code}")
-        
-        if response.status_code == 200:
-            # Parse the AI response
-            ai_response = response.json()
-            print("Raw API Response:", json.dumps(ai_response, indent=2))
-            
-            try:
-                # Extract the content from the API response
-                content = ai_response['choices'][0]['message']['content']
-                print("Content from API:", content)
-                
-                # Parse the content as JSON
-                job_listings = json.loads(content)
-                print("Parsed job listings:", json.dumps(job_listings, indent=2))
-                
-                # Format the jobs for your application
-                formatted_jobs = []
-                for job in job_listings['jobs']:  # Assuming the response has a 'jobs' array
-                    formatted_job = {
-                        "jobTitle": job["Job Title"],
-                        "companyName": job["Company Name"],
-                        "location": job["Location"],
-                        "description": job["Brief Job Description"],
-                        "requiredSkills": job["Required Skills"],
-                        "experienceLevel": job["Experience Level"],
-                        "data_share_url": job["application URL"]
-                    }
-                    formatted_jobs.append(formatted_job)
-
-                # Save the results for debugging
-                timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                with open(f"ai_job_results_{timestamp}.json", "w") as f:
-                    json.dump(formatted_jobs, f, indent=2)
-                
-                print(f"Successfully formatted {len(formatted_jobs)} jobs")
-                return formatted_jobs
+    :param job: job object with the keys requested in the prompt
+    :return: job dictionary
+    """
+    return {
+        "jobTitle": job["Job Title"],
+        "companyName": job["Company Name"],
+        "location": job["Location"],
+        "description": job["Brief Job Description"],
+        "requiredSkills": job["Required Skills"],
+        "experienceLevel": job["Experience Level"],
+        "data_share_url": job["application URL"]
+    }
 
-            except json.JSONDecodeError as e:
-                print(f"JSON parsing error: {str(e)}")
-                print("Content that failed to parse:", content)
-                return []
-            except KeyError as e:
-                print(f"Key error while processing response: {str(e)}")
-                return []
 
-        else:
-            print(f"Error from OpenAI API: {response.status_code}")
-            print("Error response:", response.text)
-            return []
+# TODO: Remove from here
+def get_ai_job_recommendations(skills, job_levels, locations, llm):
+    """
+    Get AI-powered job recommendations using a structured prompt
+
+    :param llm: LLMClient used to reach the completion API
+    """
+    try:
+        print("running!!!")
+        system, prompt = job_recommendation_prompt(skills, job_levels, locations)
+
+        print("Sending request to OpenAI API...")
+        job_listings = llm.complete_json(system, prompt)
+        print("Parsed job listings:", json.dumps(job_listings, indent=2))
+        
+        # Format the jobs for your application
+        formatted_jobs = []
+        for job in job_listings['jobs']:  # Assuming the response has a 'jobs' array
+            formatted_jobs.append(format_job(job))
+
+        print(f"Successfully formatted {len(formatted_jobs)} jobs")
+        return formatted_jobs
 
+    except LLMError as e:
+        print(f"Error from OpenAI API: {str(e)}")
+        return []
+    except KeyError as e:
+        print(f"Key error while processing response: {str(e)}")
+        return []
     except Exception as e:
         print(f"Error in AI job matching: {str(e)}")
         print("Full error details:", e.__class__.__name__)
         return []
 
+
+class RecommendationWorker:
+    """
+    Refreshes stored job recommendations in the background. Refreshes are queued
+    in the RecommendationJobs collection, at most one per user, so that any web
+    worker, or a separate `flask recommendation-worker` process, can run them.
+    A refresh requested while one is running only marks it dirty, and the
+    running refresh queues itself again when it ends, so the same user is never
+    refreshed twice at once. A job whose worker died is picked up again once
+    its lease has expired.
+
+    Web processes start polling on their first enqueue or recommendations read,
+    so CLI commands never start it. The refreshes left queued by a restart wait
+    for that first request, or for a `flask recommendation-worker` process
+    """
+
+    def __init__(self, llm, workers=2, lease=300, poll_interval=5, max_attempts=3, retry_delay=30):
+        """
+        :param llm: LLMClient used to reach the completion API
+        :param workers: number of refreshes run at the same time, 0 leaves the
+            queue to a separate worker process
+        :param lease: seconds after which a running refresh is considered abandoned
+        :param poll_interval: seconds between two looks at an empty queue
+        :param max_attempts: attempts made before a refresh is dropped
+        :param retry_delay: seconds to wait before retrying, multiplied by the attempt
+        """
+        self.llm = llm
+        self.workers = workers
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._started = False
+
+    def enqueue(self, user_id, force=False, requeue=True):
+        """
+        Queues a refresh of the user's recommendations
+
+        :param user_id: user id
+        :param force: whether to ask the model even if the preferences did not change
+        :param requeue: whether to refresh again when a refresh is already queued
+            or running
+        """
+        collection = RecommendationJobs._get_collection()
+        now = datetime.utcnow()
+        queued = {"status": "queued", "enqueuedAt": now, "runAfter": now}
+        for _ in range(MAX_UPDATE_ATTEMPTS):
+            if not requeue:
+                collection.update_one(
+                    {"_id": user_id},
+                    {"$setOnInsert": {**queued, "force": force, "attempts": 0}},
+                    upsert=True,
+                )
+                break
+            running = collection.update_one(
+                {"_id": user_id, "status": "running"},
+                {"$set": {"dirty": True}, "$max": {"force": force}},
+            )
+            if running.matched_count:
+                break
+            try:
+                collection.update_one(
+                    {"_id": user_id, "status": {"$ne": "running"}},
+                    {"$set": queued, "$max": {"force": force}, "$setOnInsert": {"attempts": 0}},
+                    upsert=True,
+                )
+                break
+            except DuplicateKeyError:
+                # claimed between the two updates, mark the running refresh instead
+                continue
+        self.start()
+        self._wake.set()
+
+    def start(self):
+        """
+        Starts polling the queue in a background thread of this process
+        """
+        if self.workers <= 0 or self._started:
+            return
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def serve(self):
+        """
+        Runs queued refreshes on a pool of worker threads, forever
+        """
+        pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="recommendations")
+        slots = threading.Semaphore(self.workers)
+
+        def run(job):
+            try:
+                self.process(job)
+            except Exception as e:
+                print(f"Error refreshing recommendations: {str(e)}")
+            finally:
+                slots.release()
+
+        while True:
+            slots.acquire()
+            try:
+                job = self.claim()
+            except Exception as e:
+                print(f"Error reading the recommendation queue: {str(e)}")
+                job = None
+            if job is None:
+                slots.release()
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+                continue
+            pool.submit(run, job)
+
+    def claim(self, user_id=None):
+        """
+        Claims the oldest runnable refresh. The claim token identifies this run,
+        so a run whose lease was taken over can no longer change the job
+
+        :param user_id: only claim the refresh of this user
+        :return: job document as it was queued, with its claim token, or None
+        """
+        now = datetime.utcnow()
+        token = uuid.uuid4().hex
+        query = {"$or": [
+            {"status": "queued", "runAfter": {"$lte": now}},
+            {"status": "running", "startedAt": {"$lt": now - timedelta(seconds=self.lease)}},
+        ]}
+        if user_id is not None:
+            query["_id"] = user_id
+        job = RecommendationJobs._get_collection().find_one_and_update(
+            query,
+            {"$set": {"status": "running", "startedAt": now, "claim": token,
+                      "dirty": False, "force": False},
+             "$inc": {"attempts": 1}},
+            sort=[("runAfter", 1)],
+            return_document=ReturnDocument.BEFORE,
+        )
+        if job is None:
+            return None
+        return {**job, "claim": token, "attempts": job.get("attempts", 0) + 1}
+
+    def process(self, job):
+        """
+        Refreshes the recommendations of a claimed job and removes it from the
+        queue, or queues it again if it was marked dirty in the meantime
+
+        :param job: job document returned by claim
+        """
+        user_id = job["_id"]
+        user = Users._get_collection().find_one(
+            {"_id": user_id}, dict.fromkeys(RECOMMENDATION_FIELDS, 1))
+        if user is None:
+            self._finish(job)
+            return
+        key = preferences_key(user)
+        stored = Recommendations._get_collection().find_one({"_id": user_id}, {"preferencesKey": 1})
+        if job.get("force") or stored is None or stored.get("preferencesKey") != key:
+            jobs = get_ai_job_recommendations(
+                user.get("skills", []), user.get("job_levels", []), user.get("locations", []),
+                self.llm)
+            if not jobs:
+                # keep the previous list and try again later
+                if job["attempts"] < self.max_attempts:
+                    retry_at = datetime.utcnow() + timedelta(seconds=self.retry_delay * job["attempts"])
+                    self._finish(job, retry_at)
+                else:
+                    self._finish(job)
+                return
+            store_recommendations(user_id, jobs, key, job["enqueuedAt"])
+        self._finish(job)
+
+    def _finish(self, job, retry_at=None):
+        collection = RecommendationJobs._get_collection()
+        claimed = {"_id": job["_id"], "claim": job["claim"]}
+        if retry_at is None and collection.delete_one({**claimed, "dirty": False}).deleted_count:
+            return
+        now = datetime.utcnow()
+        # dirty jobs run again at once with fresh attempts, failed ones after a delay
+        dirty = collection.update_one(
+            {**claimed, "dirty": True},
+            {"$set": {"status": "queued", "enqueuedAt": now, "runAfter": now, "attempts": 0},
+             "$unset": {"claim": "", "startedAt": ""}},
+        )
+        if not dirty.matched_count and retry_at is not None:
+            collection.update_one(
+                claimed,
+                {"$set": {"status": "queued", "runAfter": retry_at},
+                 "$unset": {"claim": "", "startedAt": ""}},
+            )
+        self._wake.set()
+
+
+def sse_event(event, data):
+    """
+    Formats one Server-Sent Event
+
+    :param event: event name
+    :param data: JSON serializable payload
+    :return: event text
+    """
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def stream_json_completion(llm, system, prompt, finish, item_keys=(), format_item=None):
+    """
+    Streams a JSON completion as Server-Sent Events: a "section" event for each
+    top-level member and an "item" event for each element of the arrays named in
+    item_keys as soon as they are complete, then a "done" event with the final
+    document, or an "error" event
+
+    :param llm: LLMClient used to reach the completion API
+    :param system: system message
+    :param prompt: user message
+    :param finish: function turning the parsed document into the "done" payload
+    :param item_keys: top-level keys whose array elements are streamed one by one
+    :param format_item: optional function applied to each item, items it rejects
+        with KeyError or TypeError are skipped
+    :return: generator of event texts
+    """
+    parser = IncrementalJSONParser(item_keys)
+    messages = [{"role": "system", "content": system}, {"role": "user", "content": prompt}]
+    try:
+        for delta in llm.stream(messages):
+            for kind, key, value in parser.feed(delta):
+                if kind == "item" and format_item is not None:
+                    try:
+                        value = format_item(value)
+                    except (KeyError, TypeError):
+                        continue
+                yield sse_event(kind, {"key": key, "value": value})
+        yield sse_event("done", finish(parser.result()))
+    except Exception as e:
+        print(f"Error in completion stream: {str(e)}")
+        yield sse_event("error", {"error": "Failed to get completion"})
+
+
 def create_app():
     """
     Creates a server hosted on localhost
@@ -150,6 +1046,47 @@ def create_app():
         GOOGLE_CLIENT_SECRET = info["GOOGLE_CLIENT_SECRET"]
         CONF_URL = info["CONF_URL"]
         app.secret_key = info['SECRET_KEY']
+        token_cache = TokenCache(
+            max_size=info.get("TOKEN_CACHE_SIZE", 10000),
+            ttl=info.get("TOKEN_CACHE_TTL", 60),
+        )
+        # "stored" tokens live in the AuthTokens collection, "signed" tokens
+        # are verified with SECRET_KEY and never touch the database
+        token_mode = info.get("TOKEN_MODE", "stored")
+        analyses_retention = info.get("ANALYSES_RETENTION")
+        signed_tokens = SignedTokens(info["SECRET_KEY"], TokenDenyList())
+        password_hasher = PasswordHasher(
+            n=info.get("PASSWORD_HASH_N", 2 ** 14),
+            r=info.get("PASSWORD_HASH_R", 8),
+            p=info.get("PASSWORD_HASH_P", 1),
+            workers=info.get("PASSWORD_HASH_WORKERS", 2),
+        )
+        llm = LLMClient(
+            url=info.get("LLM_URL", DEFAULT_URL),
+            model=info.get("LLM_MODEL", DEFAULT_MODEL),
+            connect_timeout=info.get("LLM_CONNECT_TIMEOUT", 5),
+            read_timeout=info.get("LLM_READ_TIMEOUT", 60),
+            max_retries=info.get("LLM_MAX_RETRIES", 2),
+            # identical concurrent completions are coalesced within the worker,
+            # and across workers through Mongo when LLM_COALESCE_SHARED is set
+            single_flight=SingleFlight(
+                store=MongoFlightStore() if info.get("LLM_COALESCE_SHARED") else None,
+                wait_timeout=info.get("LLM_READ_TIMEOUT", 60),
+            ),
+        )
+        insight_cache = InsightCache(
+            max_size=info.get("SEARCH_CACHE_SIZE", 1000),
+            ttl=info.get("SEARCH_CACHE_TTL", 7 * 86400),
+            memory_ttl=info.get("SEARCH_CACHE_MEMORY_TTL", 300),
+        )
+        recommendation_worker = RecommendationWorker(
+            llm, workers=info.get("RECOMMENDATION_WORKERS", 2))
+        recommendations_max_age = info.get("RECOMMENDATIONS_MAX_AGE", 86400)
+        oidc_metadata = OIDCMetadataCache(
+            CONF_URL,
+            ttl=info.get("OIDC_METADATA_TTL", 86400),
+            refresh_interval=info.get("OIDC_METADATA_REFRESH", 3600),
+        )
 
     # with open("application.yml") as f:
     #     info = yaml.load(f, Loader=yaml.FullLoader)
@@ -157,8 +1094,44 @@ def create_app():
 
 
     app.config["CORS_HEADERS"] = "Content-Type"
+    app.token_cache = token_cache
+    app.password_hasher = password_hasher
+    app.llm_client = llm
+    app.insight_cache = insight_cache
+    app.recommendation_worker = recommendation_worker
 
     oauth = OAuth(app)
+    oauth.register(
+        name='google',
+        client_id=GOOGLE_CLIENT_ID,
+        client_secret=GOOGLE_CLIENT_SECRET,
+        server_metadata_url=CONF_URL,
+        client_kwargs={
+            'scope': 'openid email profile'
+        },
+        nonce='foobar'
+    )
+    app.oidc_metadata = oidc_metadata
+
+    def google_client():
+        """
+        Returns the Google OAuth client primed with the cached provider metadata
+
+        :return: Authlib OAuth client
+        """
+        return oidc_metadata.apply(oauth.google)
+
+    @app.after_request
+    def expose_query_count(response):
+        """
+        Reports the number of database round-trips of the request in the
+        X-Query-Count header when EXPOSE_QUERY_COUNT is enabled
+
+        :return: response
+        """
+        if app.config.get("EXPOSE_QUERY_COUNT"):
+            response.headers["X-Query-Count"] = str(g.get("query_count", 0))
+        return response
 
     @app.errorhandler(404)
     def page_not_found():
@@ -195,27 +1168,25 @@ def create_app():
                     token = headers["Authorization"].split(" ")[1]
                 except:
                     return jsonify({"error": "Unauthorized"}), 401
+                if token_mode == "signed":
+                    if signed_tokens.verify(token) is None:
+                        return jsonify({"error": "Unauthorized"}), 401
+                    return None
+                if token_cache.get(token) is not None:
+                    return None
                 userid = token.split(".")[0]
-                user = Users.objects(id=userid).first()
-
-                if user is None:
-                    return jsonify({"error": "Unauthorized"}), 401
-
-                expiry_flag = False
-                for tokens in user["authTokens"]:
-                    if tokens["token"] == token:
-                        expiry = tokens["expiry"]
-                        expiry_time_object = datetime.strptime(
-                            expiry, "%m/%d/%Y, %H:%M:%S"
-                        )
-                        if datetime.now() <= expiry_time_object:
-                            expiry_flag = True
-                        else:
-                            delete_auth_token(tokens, userid)
-                        break
-
-                if not expiry_flag:
+                auth_token = AuthTokens.objects(token=token).only(
+                    "userId", "expiry").first()
+
+                # expired tokens are reaped by the TTL index, but the reaper
+                # only runs periodically so the expiry is checked here as well
+                if (
+                    auth_token is None
+                    or str(auth_token.userId) != userid
+                    or auth_token.expiry < datetime.utcnow()
+                ):
                     return jsonify({"error": "Unauthorized"}), 401
+                token_cache.set(token, userid, auth_token.expiry)
 
         except:
             return jsonify({"error": "Internal server error"}), 500
@@ -242,20 +1213,106 @@ def create_app():
         userid = token.split(".")[0]
         return userid
 
-    def delete_auth_token(token_to_delete, user_id):
+    def get_current_user(*fields):
+        """
+        Loads the user making the request at most once per request. Handlers
+        declare the fields they need; without fields every field except the
+        legacy embedded lists is loaded
+
+        :param fields: names of the fields the handler reads
+        :return: Users object
+        """
+        cached = g.get("current_user")
+        loaded_fields = g.get("current_user_fields")
+        if cached is not None and (
+            loaded_fields is None or (fields and loaded_fields.issuperset(fields))
+        ):
+            return cached
+
+        query = Users.objects(id=get_userid_from_header())
+        if fields and loaded_fields is not None:
+            fields = loaded_fields.union(fields)
+        if fields:
+            query = query.only(*fields)
+        else:
+            query = query.exclude(*LEGACY_USER_FIELDS)
+        g.current_user = query.first()
+        g.current_user_fields = set(fields) if fields else None
+        return g.current_user
+
+    def delete_auth_token(token_to_delete):
         """
-        Deletes authorization token of the given user from the database
+        Deletes the authorization token from the database
 
         :param token_to_delete: token to be deleted
-        :param user_id: user id of the current active user
-        :return: string
         """
-        user = Users.objects(id=user_id).first()
-        auth_tokens = []
-        for token in user["authTokens"]:
-            if token != token_to_delete:
-                auth_tokens.append(token)
-        user.update(authTokens=auth_tokens)
+        if token_mode == "signed":
+            signed_tokens.revoke(token_to_delete)
+            return
+        token_cache.invalidate(token_to_delete)
+        AuthTokens.objects(token=token_to_delete).delete()
+
+    def create_session_token(user_id, opaque_token):
+        """
+        Issues a session token for the user according to the configured TOKEN_MODE
+
+        :param user_id: user id of the token owner
+        :param opaque_token: random part of the token used in "stored" mode
+        :return: token and its expiry formatted for the client
+        """
+        if token_mode == "signed":
+            return signed_tokens.issue(user_id)
+        token = f"{user_id}.{opaque_token}"
+        return token, issue_auth_token(user_id, token)
+
+    def wants_stream():
+        """
+        Tells whether the client asked for Server-Sent Events, with ?stream=1
+        or an Accept: text/event-stream header
+
+        :return: boolean
+        """
+        return (request.args.get("stream") in ("1", "true")
+                or "text/event-stream" in request.headers.get("Accept", ""))
+
+    def sse_response(events):
+        """
+        Wraps a generator of events in an unbuffered text/event-stream response
+
+        :param events: generator of event texts
+        :return: streamed response
+        """
+        return Response(stream_with_context(events), mimetype="text/event-stream",
+                        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+    def insights_response(job_title, system, prompt, prompt_version):
+        """
+        Answers a /search from the insight cache or the model, as JSON or,
+        when requested, as Server-Sent Events
+
+        :param job_title: keywords of the search
+        :param system: system message
+        :param prompt: user message
+        :param prompt_version: version of the prompt, part of the cache key
+        :return: response
+        """
+        insights = insight_cache.get(job_title, llm.model, prompt_version)
+        if wants_stream():
+            if insights is not None:
+                events = (
+                    [sse_event("section", {"key": k, "value": v}) for k, v in insights.items()]
+                    + [sse_event("done", insights)]
+                )
+                return sse_response(iter(events))
+
+            def finish(document):
+                insight_cache.set(job_title, llm.model, prompt_version, document)
+                return document
+            return sse_response(stream_json_completion(llm, system, prompt, finish))
+        if insights is None:
+            insights = llm.complete_json(system, prompt)
+            insight_cache.set(job_title, llm.model, prompt_version, insights)
+        return jsonify(insights), 200
 
     @app.route("/")
     @cross_origin()
@@ -265,62 +1322,27 @@ def create_app():
     @app.route("/users/signupGoogle")
     def signupGoogle():
 
-        oauth.register(
-            name='google',
-            client_id=GOOGLE_CLIENT_ID,
-            client_secret=GOOGLE_CLIENT_SECRET,
-            server_metadata_url=CONF_URL,
-            client_kwargs={
-                'scope': 'openid email profile'
-            },
-            nonce='foobar'
-        )
-
         # Redirect to google_auth function
         redirect_uri = url_for('authorized', _external=True)
         print(redirect_uri)
 
         session['nonce'] = generate_token()
-        return oauth.google.authorize_redirect(redirect_uri, nonce=session['nonce'])
+        return google_client().authorize_redirect(redirect_uri, nonce=session['nonce'])
 
     @app.route('/users/signupGoogle/authorized')
     def authorized():
         print("Entered google auth!")
-        token = oauth.google.authorize_access_token()
-        user = oauth.google.parse_id_token(token, nonce=session['nonce'])
+        google = google_client()
+        token = google.authorize_access_token()
+        user = google.parse_id_token(token, nonce=session['nonce'])
         session['user'] = user
 
-        user_exists = Users.objects(email=user["email"]).first()
-
-        users_email = user["email"]
+        if not user['email_verified']:
+            return jsonify({"error": "Email not verified"}), 401
         full_name = user["given_name"] + " " + user["family_name"]
+        unique_id = find_or_create_google_user(user["email"], full_name)
 
-        if user['email_verified']:
-            if user_exists is None:
-                userSave = Users(
-                    id=get_new_user_id(),
-                    fullName=full_name,
-                    email=users_email,
-                    authTokens=[],
-                    applications=[],
-                    skills=[],
-                    job_levels=[],
-                    locations=[],
-                    phone_number="",
-                    address=""
-                )
-                userSave.save()
-                unique_id = userSave['id']
-            else:
-                unique_id = user_exists['id']
-
-        userSaved = Users.objects(email=user['email']).first()
-        expiry = datetime.now() + timedelta(days=1)
-        expiry_str = expiry.strftime("%m/%d/%Y, %H:%M:%S")
-        token_whole = str(unique_id) + "." + token['access_token']
-        auth_tokens_new = userSaved['authTokens'] + \
-            [{"token": token_whole, "expiry": expiry_str}]
-        userSaved.update(authTokens=auth_tokens_new)
+        token_whole, expiry_str = create_session_token(unique_id, token['access_token'])
 
         return redirect(f"http://127.0.0.1:3000/?token={token_whole}&expiry={expiry_str}&userId={unique_id}")
 
@@ -345,15 +1367,15 @@ def create_app():
             username_exists = Users.objects(username=data["username"])
             if len(username_exists) != 0:
                 return jsonify({"error": "Username already exists"}), 400
-            password = data["password"]
-            password_hash = hashlib.md5(password.encode())
+            try:
+                password_hash = password_hasher.hash(data["password"])
+            except TimeoutError:
+                return jsonify({"error": "Server busy, try again"}), 503
             user = Users(
                 id=get_new_user_id(),
                 fullName=data["fullName"],
                 username=data["username"],
-                password=password_hash.hexdigest(),
-                authTokens=[],
-                applications=[],
+                password=password_hash,
                 skills=[],
                 job_levels=[],
                 locations=[],
@@ -362,7 +1384,11 @@ def create_app():
                 institution="",
                 email=""
             )
-            user.save()
+            try:
+                user.save()
+            except NotUniqueError:
+                # a concurrent sign-up took the username after the check above
+                return jsonify({"error": "Username already exists"}), 400
             # del user.to_json()["password", "authTokens"]
             return jsonify(user.to_json()), 200
         except Exception as e:
@@ -379,8 +1405,7 @@ def create_app():
         :return: JSON object with application data
         """
         try:
-            userid = get_userid_from_header()
-            user = Users.objects(id=userid).first()
+            user = get_current_user(*PROFILE_FIELDS)
             profileInformation = {}
             profileInformation["skills"] = user["skills"]
             profileInformation["job_levels"] = user["job_levels"]
@@ -398,20 +1423,33 @@ def create_app():
     @app.route("/updateProfile", methods=["POST"])
     def updateProfilePreferences():
         """
-        Update the user profile with preferences: skills, job-level and location
+        Update the user profile with preferences: skills, job-level and location.
+        Only the profile fields present in the request are validated and written
+
+        :return: JSON object with the updated profile
         """
         try:
-            print(request.data)
             userid = get_userid_from_header()
-            user = Users.objects(id=userid).first()
-            data = json.loads(request.data)
-            print(user)
-
-            for key in data.keys():
-                user[key] = data[key]
-            user.save()
-            return jsonify(user.to_json()), 200
-
+            try:
+                changes = validate_profile_update(json.loads(request.data))
+            except ValueError as err:
+                return jsonify({"error": str(err)}), 400
+
+            profile = Users._get_collection().find_one_and_update(
+                {"_id": int(userid)},
+                {"$set": changes},
+                projection=dict.fromkeys(("username",) + PROFILE_FIELDS, 1),
+                return_document=ReturnDocument.AFTER,
+            )
+            if profile is None:
+                return jsonify({"error": "Unauthorized"}), 401
+            if changes.keys() & set(RECOMMENDATION_FIELDS):
+                recommendation_worker.enqueue(profile["_id"])
+            profile["id"] = profile.pop("_id")
+            return jsonify(profile), 200
+
+        except DuplicateKeyError:
+            return jsonify({"error": "Email already in use"}), 409
         except Exception as err:
             print(err)
             return jsonify({"error": "Internal server error"}), 500
@@ -419,17 +1457,55 @@ def create_app():
     @app.route("/getRecommendations", methods=["GET"])
     def getRecommendations():
         """
-        Get AI-powered job recommendations based on user's profile
+        Get AI-powered job recommendations based on user's profile. The list
+        stored by the background worker is returned at once; when it is older
+        than RECOMMENDATIONS_MAX_AGE, was made for other preferences, or
+        ?refresh=1 is passed, a refresh is queued and the stored list is still
+        returned (stale-while-revalidate). Only users without a stored list wait
+        for the model. With ?stream=1 each job is sent as a Server-Sent Event as
+        soon as it is generated
         """
         try:
-            userid = get_userid_from_header()
-            user = Users.objects(id=userid).first()
+            user = get_current_user(*RECOMMENDATION_FIELDS)
+            # picks up the refreshes left queued by a restart
+            recommendation_worker.start()
+            if wants_stream():
+                system, prompt = job_recommendation_prompt(
+                    user["skills"], user["job_levels"], user["locations"])
+
+                def finish(document):
+                    jobs = []
+                    for job in document.get("jobs", []):
+                        try:
+                            jobs.append(format_job(job))
+                        except (KeyError, TypeError):
+                            continue
+                    return {"jobs": jobs}
+                return sse_response(stream_json_completion(
+                    llm, system, prompt, finish, item_keys=("jobs",), format_item=format_job))
             
+            key = preferences_key({field: user[field] for field in RECOMMENDATION_FIELDS})
+            stored = Recommendations._get_collection().find_one({"_id": user.id})
+            if stored is not None:
+                outdated = (stored.get("preferencesKey") != key
+                            or datetime.utcnow() - stored["updatedAt"]
+                            > timedelta(seconds=recommendations_max_age))
+                refresh = request.args.get("refresh") in ("1", "true")
+                if outdated or refresh:
+                    recommendation_worker.enqueue(user.id, force=refresh, requeue=refresh)
+                headers = {
+                    "X-Recommendations-Updated-At": stored["updatedAt"].isoformat(),
+                    "X-Recommendations-Stale": str(outdated or refresh).lower(),
+                }
+                return jsonify(stored["jobs"]), 200, headers
+
             # Get AI-powered recommendations
+            requested_at = datetime.utcnow()
             recommendedJobs = get_ai_job_recommendations(
                 user["skills"],
                 user["job_levels"],
-                user["locations"]
+                user["locations"],
+                llm,
             )
             
             if not recommendedJobs:
@@ -437,6 +1513,7 @@ def create_app():
                     "message": "No matching jobs found. Please update your profile with skills and preferences."
                 }), 200
 
+            store_recommendations(user.id, recommendedJobs, key, requested_at)
             return jsonify(recommendedJobs), 200
 
         except Exception as err:
@@ -507,18 +1584,21 @@ def create_app():
                 return jsonify({"error": "User not found"}), 400
 
             # Hash entered password and compare with stored password
-            entered_password_hash = hashlib.md5(data["password"].encode()).hexdigest()
-            if user.password != entered_password_hash:
-                return jsonify({"error": "Wrong username or password"}), 400
-
-            # Generate session token
-            expiry = datetime.now() + timedelta(days=1)
-            expiry_str = expiry.strftime("%m/%d/%Y, %H:%M:%S")
-            token = f"{user.id}.{uuid.uuid4()}"
-
-            # Store token
-            user.authTokens.append({"token": token, "expiry": expiry_str})
-            user.save()
+            try:
+                if not password_hasher.verify(data["password"], user.password):
+                    return jsonify({"error": "Wrong username or password"}), 400
+                if password_hasher.needs_rehash(user.password):
+                    # the filter on the old hash keeps concurrent logins from
+                    # overwriting a newer password
+                    Users._get_collection().update_one(
+                        {"_id": user.id, "password": user.password},
+                        {"$set": {"password": password_hasher.hash(data["password"])}},
+                    )
+            except TimeoutError:
+                return jsonify({"error": "Server busy, try again"}), 503
+
+            # Generate and store session token
+            token, expiry_str = create_session_token(user.id, uuid.uuid4())
 
             # Return full profile in response
             return jsonify({
@@ -552,14 +1632,7 @@ def create_app():
         :return: JSON object with status and message
         """
         try:
-            userid = get_userid_from_header()
-            user = Users.objects(id=userid).first()
-            auth_tokens = []
-            incoming_token = get_token_from_header()
-            for token in user["authTokens"]:
-                if token["token"] != incoming_token:
-                    auth_tokens.append(token)
-            user.update(authTokens=auth_tokens)
+            delete_auth_token(get_token_from_header())
 
             return jsonify({"success": ""}), 200
 
@@ -663,53 +1736,13 @@ def create_app():
             4. Realistic and practical
             """
 
-        # Rest of the code remains the same...
-
-            headers = {
-                "Authorization": f"Bearer {os.getenv('OPENAI_API_KEY')}",
-                "Content-Type": "application/json"
-            }
-            
-            data = {
-                "model": "gpt-3.5-turbo",
-                "messages": [
-                    {
-                        "role": "system",
-                        "content": "You are a career advisor. Return only JSON without any markdown formatting."
-                    },
-                    {"role": "user", "content": prompt}
-                ],
-                "temperature": 0.7,
-                "response_format": { "type": "json_object" }
-            }
-
-            response = requests.post(
-                "https://api.openai.com/v1/chat/completions",
-                headers=headers,
-                json=data
+            return insights_response(
+                job_title,
+                "You are a career advisor. Return only JSON without any markdown formatting.",
+                prompt,
+                SEARCH_PROMPT_VERSION,
             )
 
-            if response.status_code == 200:
-                result = response.json()
-                content = result['choices'][0]['message']['content']
-                
-                # Clean the content string
-                content = content.strip()
-                if content.startswith('```json'):
-                    content = content[7:]
-                if content.startswith('```'):
-                    content = content[3:]
-                if content.endswith('```'):
-                    content = content[:-3]
-                
-                # Parse the JSON content
-                insights = json.loads(content.strip())
-                
-                # Return the parsed JSON directly
-                return jsonify(insights), 200
-            else:
-                return jsonify({"error": "Failed to get insights"}), 500
-
         except Exception as e:
             print(f"Error in search: {str(e)}")
             return jsonify({"error": "Internal server error"}), 500
@@ -766,55 +1799,90 @@ def create_app():
                 }}
                 """
 
-            # OpenAI API call
-            headers = {
-                "Authorization": f"Bearer {os.getenv('OPENAI_API_KEY')}",
-                "Content-Type": "application/json"
-            }
-            
-            data = {
-                "model": "gpt-3.5-turbo",
-                "messages": [
-                    {
-                        "role": "system",
-                        "content": "You are a career advisor and industry expert providing detailed insights about tech roles."
-                    },
-                    {"role": "user", "content": prompt}
-                ],
-                "temperature": 0.7,
-                "response_format": { "type": "json_object" }
-            }
-
-            response = requests.post(
-                "https://api.openai.com/v1/chat/completions",
-                headers=headers,
-                json=data
+            return insights_response(
+                job_title,
+                "You are a career advisor and industry expert providing detailed insights about tech roles.",
+                prompt,
+                SEARCH_JOBS_PROMPT_VERSION,
             )
 
-            if response.status_code == 200:
-                result = response.json()
-                insights = json.loads(result['choices'][0]['message']['content'])
-                return jsonify(insights), 200
-            else:
-                return jsonify({"error": "Failed to get insights"}), 500
-
         except Exception as e:
             print(f"Error in search: {str(e)}")
             return jsonify({"error": "Internal server error"}), 500
     
+    @app.route("/search/cache", methods=["GET"])
+    def search_cache_stats():
+        """
+        Reports the hit ratio of the /search insight cache of this worker
+
+        :return: JSON object with cache statistics
+        """
+        return jsonify(insight_cache.stats()), 200
+
     # get data from the CSV file for rendering root page
     @app.route("/applications", methods=["GET"])
     def get_data():
         """
-        Gets user's applications data from the database
+        Gets user's applications data from the database. Without a limit every
+        application is returned as a list. With a limit one page is returned
+        together with the cursor to pass as "after" for the next page.
+        The applications can be filtered by status (comma separated), companyName
+        prefix and dateFrom/dateTo, and reduced to a comma separated list of fields
 
         :return: JSON object with application data
         """
         try:
-            userid = get_userid_from_header()
-            user = Users.objects(id=userid).first()
-            applications = user["applications"]
-            return jsonify(applications)
+            userid = int(get_userid_from_header())
+            sort = request.args.get("sort", "id")
+            descending = sort.startswith("-")
+            field = sort.lstrip("-")
+            if field not in APPLICATION_SORT_FIELDS:
+                return jsonify({"error": "Invalid sort field"}), 400
+
+            try:
+                query = application_filter(userid, request.args)
+                fields = parse_fields(request.args.get("fields"))
+            except ValueError as err:
+                return jsonify({"error": str(err)}), 400
+            after = request.args.get("after")
+            if after:
+                try:
+                    value, last_id = decode_cursor(after)
+                except:
+                    return jsonify({"error": "Invalid cursor"}), 400
+                query = {"$and": [
+                    query, application_page_filter(field, value, last_id, descending)]}
+
+            projection = APPLICATION_PROJECTION
+            if fields:
+                # the sort key is needed to build the next cursor
+                projection = {"_id": 0, "id": 1, field: 1, **{f: 1 for f in fields}}
+
+            direction = -1 if descending else 1
+            sort_spec = [("id", direction)]
+            if field != "id":
+                sort_spec.insert(0, (field, direction))
+            cursor = Applications._get_collection().find(query, projection).sort(sort_spec)
+
+            limit = request.args.get("limit", type=int)
+            next_cursor = None
+            if limit is None:
+                applications = list(cursor)
+            else:
+                limit = max(1, min(limit, MAX_PAGE_SIZE))
+                applications = list(cursor.limit(limit + 1))
+                if len(applications) > limit:
+                    applications = applications[:limit]
+                    last = applications[-1]
+                    next_cursor = encode_cursor([last.get(field), last["id"]])
+            if fields:
+                applications = [
+                    {key: value for key, value in application.items() if key in fields}
+                    for application in applications
+                ]
+            if limit is None:
+                return jsonify(applications)
+            return jsonify({"applications": applications, "next": next_cursor})
         except:
             return jsonify({"error": "Internal server error"}), 500
 
@@ -833,24 +1901,190 @@ def create_app():
                 _ = request_data["companyName"]
             except:
                 return jsonify({"error": "Missing fields in input"}), 400
+            try:
+                date = normalize_date(request_data.get("date"))
+            except ValueError as err:
+                return jsonify({"error": str(err)}), 400
 
-            user = Users.objects(id=userid).first()
+            application_id = allocate_application_ids(userid)
+            if application_id is None:
+                return jsonify({"error": "Unauthorized"}), 401
             current_application = {
-                "id": get_new_application_id(userid),
+                "id": application_id,
                 "jobTitle": request_data["jobTitle"],
                 "companyName": request_data["companyName"],
-                "date": request_data.get("date"),
+                "date": date,
                 "jobLink": request_data.get("jobLink"),
                 "location": request_data.get("location"),
                 "status": request_data.get("status", "1"),
             }
-            applications = user["applications"] + [current_application]
-
-            user.update(applications=applications)
+            Applications._get_collection().insert_one({
+                "userId": int(userid),
+                **current_application,
+                "searchTerms": search_terms(current_application),
+            })
             return jsonify(current_application), 200
         except:
             return jsonify({"error": "Internal server error"}), 500
 
+    @app.route("/applications/import", methods=["POST"])
+    def import_applications():
+        """
+        Imports applications from an uploaded CSV or NDJSON file. The file is
+        parsed as a stream and inserted in batches; rows that fail validation
+        or insertion are reported with their row number
+
+        :return: JSON object with the number of imported rows and the row errors
+        """
+        try:
+            userid = int(get_userid_from_header())
+            try:
+                file = request.files["file"]
+            except:
+                return jsonify({"error": "No file found in the input"}), 400
+            file_format = request.args.get("format") or file.filename.rsplit(".", 1)[-1]
+            file_format = file_format.lower()
+            if file_format not in IMPORT_FORMATS:
+                return jsonify({"error": "File must be CSV or NDJSON"}), 400
+
+            imported = 0
+            errors = []
+            batch = []
+
+            def flush():
+                inserted, failed = insert_application_batch(userid, batch)
+                errors.extend(failed)
+                batch.clear()
+                return inserted
+
+            # TextIOWrapper needs readable(), which SpooledTemporaryFile lacks before Python 3.11
+            stream = codecs.getreader("utf-8-sig")(file.stream)
+            try:
+                for row_number, row in read_import_rows(stream, file_format):
+                    try:
+                        batch.append((row_number, application_from_row(row)))
+                    except ValueError as err:
+                        errors.append({"row": row_number, "error": str(err)})
+                    if len(batch) >= IMPORT_BATCH_SIZE:
+                        imported += flush()
+            except UnicodeDecodeError:
+                # rows of the batches already flushed stay imported
+                return jsonify({
+                    "error": "File is not valid UTF-8, save it with UTF-8 encoding",
+                    "imported": imported,
+                }), 400
+            if batch:
+                imported += flush()
+
+            return jsonify({
+                "imported": imported,
+                "failed": len(errors),
+                "errors": errors[:MAX_REPORTED_ERRORS],
+            }), 200
+        except Exception as e:
+            print(f"Error importing applications: {str(e)}")
+            return jsonify({"error": "Internal server error"}), 500
+
+    @app.route("/applications/export", methods=["GET"])
+    def export_applications():
+        """
+        Streams the user's applications as CSV, in the column layout of
+        data/applications.csv, or as NDJSON
+
+        :return: streamed response with the applications
+        """
+        try:
+            userid = int(get_userid_from_header())
+            file_format = request.args.get("format", "csv").lower()
+            if file_format not in EXPORT_FORMATS:
+                return jsonify({"error": "Format must be csv or ndjson"}), 400
+
+            cursor = Applications._get_collection().find(
+                {"userId": userid}, APPLICATION_PROJECTION
+            ).sort("id", 1).batch_size(EXPORT_BATCH_SIZE)
+            if file_format == "csv":
+                rows = stream_csv(APPLICATION_EXPORT_COLUMNS, (
+                    [a.get("jobTitle"), a.get("companyName"), a.get("date"),
+                     a.get("status"), a.get("id")]
+                    for a in cursor
+                ))
+            else:
+                rows = stream_ndjson(cursor)
+            return export_response(rows, file_format, "applications")
+        except:
+            return jsonify({"error": "Internal server error"}), 500
+
+    @app.route("/applications/stats", methods=["GET"])
+    def application_stats():
+        """
+        Summarizes the user's applications for the dashboard: counts per status,
+        applications per ISO week and the most applied to companies, computed in
+        a single aggregation
+
+        :return: JSON object with total, byStatus, byWeek and topCompanies
+        """
+        try:
+            userid = int(get_userid_from_header())
+            try:
+                top = min(int(request.args.get("top", DEFAULT_TOP_COMPANIES)),
+                          MAX_TOP_COMPANIES)
+            except ValueError:
+                return jsonify({"error": "top must be an integer"}), 400
+            if top < 1:
+                return jsonify({"error": "top must be positive"}), 400
+
+            stats = next(Applications._get_collection().aggregate(
+                application_stats_pipeline(userid, top)
+            ))
+            return jsonify({
+                "total": stats["total"][0]["count"] if stats["total"] else 0,
+                "byStatus": {s["_id"]: s["count"] for s in stats["byStatus"]},
+                "byWeek": [
+                    {"week": "%d-W%02d" % (w["_id"]["year"], w["_id"]["week"]),
+                     "count": w["count"]}
+                    for w in stats["byWeek"]
+                ],
+                "topCompanies": [
+                    {"companyName": c["_id"], "count": c["count"]}
+                    for c in stats["topCompanies"]
+                ],
+            })
+        except:
+            return jsonify({"error": "Internal server error"}), 500
+
+    @app.route("/applications/search", methods=["GET"])
+    def search_applications():
+        """
+        Searches the user's applications by job title, company name and location.
+        Every word of q must prefix a word of the application; results are ranked
+        by how well and in which fields they match
+
+        :return: JSON object with the ranked applications
+        """
+        try:
+            userid = int(get_userid_from_header())
+            tokens = tokenize(request.args.get("q", ""))[:MAX_SEARCH_TOKENS]
+            if not tokens:
+                return jsonify({"error": "Missing search query"}), 400
+            limit = request.args.get("limit", DEFAULT_SEARCH_LIMIT, type=int)
+            limit = max(1, min(limit, MAX_PAGE_SIZE))
+
+            # the longest prefix is the most selective one to scan the index with
+            tokens.sort(key=len, reverse=True)
+            candidates = Applications._get_collection().find(
+                {"userId": userid, "$and": [
+                    {"searchTerms": re.compile("^" + re.escape(t))} for t in tokens
+                ]},
+                APPLICATION_PROJECTION,
+            ).limit(MAX_SEARCH_CANDIDATES)
+            ranked = sorted(
+                ((search_score(a, tokens), a) for a in candidates),
+                key=lambda scored: (-scored[0], -scored[1]["id"]),
+            )
+            return jsonify({"applications": [a for _, a in ranked[:limit]]}), 200
+        except:
+            return jsonify({"error": "Internal server error"}), 500
+
     @app.route("/applications/<int:application_id>", methods=["PUT"])
     def update_application(application_id):
         """
@@ -866,27 +2100,47 @@ def create_app():
             except:
                 return jsonify({"error": "No fields found in input"}), 400
 
-            user = Users.objects(id=userid).first()
-            current_applications = user["applications"]
+            # ids are handed out by the user's sequence and cannot be changed
+            changes = {key: value for key, value in request_data.items()
+                       if key not in ("id", "userId", "searchTerms")}
+            if not changes:
+                return jsonify({"error": "No fields found in input"}), 400
+            if any("." in key or key.startswith("$") for key in changes):
+                return jsonify({"error": "Invalid field name in input"}), 400
+            if "date" in changes:
+                try:
+                    changes["date"] = normalize_date(changes["date"])
+                except ValueError as err:
+                    return jsonify({"error": str(err)}), 400
+
+            collection = Applications._get_collection()
+            query = {"userId": int(userid), "id": application_id}
+            kept = [field for field in SEARCH_FIELDS if field not in changes]
+            application = None
+            for _ in range(MAX_UPDATE_ATTEMPTS):
+                current, guard = {}, {}
+                if SEARCH_FIELDS.keys() & changes.keys() and kept:
+                    # the search terms also depend on the fields left unchanged,
+                    # the update only applies if they are still the ones read
+                    current = collection.find_one(query, dict.fromkeys(kept, 1))
+                    if current is None:
+                        break
+                    guard = {field: current.get(field) for field in kept}
+                update = dict(changes)
+                if SEARCH_FIELDS.keys() & changes.keys():
+                    update["searchTerms"] = search_terms({**current, **changes})
+                application = collection.find_one_and_update(
+                    {**query, **guard},
+                    {"$set": update},
+                    projection=APPLICATION_PROJECTION,
+                    return_document=ReturnDocument.AFTER,
+                )
+                if application is not None or not guard:
+                    break
+            if application is None:
+                return jsonify({"error": "Application not found"}), 400
 
-            if len(current_applications) == 0:
-                return jsonify({"error": "No applications found"}), 400
-            else:
-                updated_applications = []
-                app_to_update = None
-                application_updated_flag = False
-                for application in current_applications:
-                    if application["id"] == application_id:
-                        app_to_update = application
-                        application_updated_flag = True
-                        for key, value in request_data.items():
-                            application[key] = value
-                    updated_applications += [application]
-                if not application_updated_flag:
-                    return jsonify({"error": "Application not found"}), 400
-                user.update(applications=updated_applications)
-
-            return jsonify(app_to_update), 200
+            return jsonify(application), 200
         except:
             return jsonify({"error": "Internal server error"}), 500
 
@@ -900,24 +2154,13 @@ def create_app():
         """
         try:
             userid = get_userid_from_header()
-            user = Users.objects(id=userid).first()
-
-            current_applications = user["applications"]
-
-            application_deleted_flag = False
-            updated_applications = []
-            app_to_delete = None
-            for application in current_applications:
-                if application["id"] != application_id:
-                    updated_applications += [application]
-                else:
-                    app_to_delete = application
-                    application_deleted_flag = True
-
-            if not application_deleted_flag:
+            application = Applications._get_collection().find_one_and_delete(
+                {"userId": int(userid), "id": application_id},
+                projection=APPLICATION_PROJECTION,
+            )
+            if application is None:
                 return jsonify({"error": "Application not found"}), 400
-            user.update(applications=updated_applications)
-            return jsonify(app_to_delete), 200
+            return jsonify(application), 200
         except:
             return jsonify({"error": "Internal server error"}), 500
 
@@ -929,13 +2172,12 @@ def create_app():
         :return: JSON object with status and message
         """
         try:
-            userid = get_userid_from_header()
             try:
                 file = request.files["file"]  # .read()
             except:
                 return jsonify({"error": "No resume file found in the input"}), 400
 
-            user = Users.objects(id=userid).first()
+            user = get_current_user("resume")
             if not user.resume.read():
                 # There is no file
                 user.resume.put(file, filename=file.filename,
@@ -960,9 +2202,8 @@ def create_app():
         :return: response with file
         """
         try:
-            userid = get_userid_from_header()
             try:
-                user = Users.objects(id=userid).first()
+                user = get_current_user("resume")
                 if len(user.resume.read()) == 0:
                     raise FileNotFoundError
                 else:
@@ -999,11 +2240,6 @@ def create_app():
                 text += page.extract_text()
 
             # Use GPT to structure the resume content
-            headers = {
-                "Authorization": f"Bearer {os.getenv('OPENAI_API_KEY')}",
-                "Content-Type": "application/json"
-            }
-            
             prompt = f"""
             Parse this resume text and extract key information in JSON format:
             {text}
@@ -1017,21 +2253,8 @@ def create_app():
             }}
             """
             
-            response = requests.post(
-                "https://api.openai.com/v1/chat/completions",
-                headers=headers,
-                json={
-                    "model": "gpt-3.5-turbo",
-                    "messages": [
-                        {"role": "system", "content": "You are a resume parser."},
-                        {"role": "user", "content": prompt}
-                    ],
-                    "temperature": 0.7
-                }
-            )
-            
-            parsed_resume = response.json()['choices'][0]['message']['content']
-            return jsonify(json.loads(parsed_resume))
+            parsed_resume = llm.complete_json("You are a resume parser.", prompt)
+            return jsonify(parsed_resume)
 
         except Exception as e:
             print(f"Error parsing resume: {str(e)}")
@@ -1045,11 +2268,6 @@ def create_app():
             job_insights = data['jobInsights']
             
             # Use GPT to compare resume with job requirements
-            headers = {
-                "Authorization": f"Bearer {os.getenv('OPENAI_API_KEY')}",
-                "Content-Type": "application/json"
-            }
-            
             prompt = f"""
             Compare this resume with the job requirements and provide a detailed analysis:
             Resume: {json.dumps(resume)}
@@ -1064,70 +2282,206 @@ def create_app():
             }}
             """
             
-            response = requests.post(
-                "https://api.openai.com/v1/chat/completions",
-                headers=headers,
-                json={
-                    "model": "gpt-3.5-turbo",
-                    "messages": [
-                        {"role": "system", "content": "You are a resume analyzer."},
-                        {"role": "user", "content": prompt}
-                    ],
-                    "temperature": 0.7
-                }
-            )
-            
-            comparison = response.json()['choices'][0]['message']['content']
-            return jsonify(json.loads(comparison))
+            comparison = llm.complete_json(
+                "You are a resume analyzer. Respond with JSON.", prompt)
+            return jsonify(comparison)
+
+        except Exception as e:
+            print(f"Error comparing resume: {str(e)}")
+            return jsonify({"error": "Failed to compare resume"}), 500
+    
+        
+    @app.errorhandler(404)
+    def page_not_found(error):  # Add error parameter
+        """
+        Returns a json object to indicate error 404
+
+        :return: JSON object
+        """
+        return jsonify({"error": "Not Found"}), 404
+
+    @app.cli.command("migrate-auth-tokens")
+    def migrate_auth_tokens_command():
+        """
+        Moves the tokens embedded in Users.authTokens into the AuthTokens collection
+        """
+        print(f"Migrated {migrate_auth_tokens()} auth tokens")
+
+    @app.cli.command("migrate-applications")
+    def migrate_applications_command():
+        """
+        Moves the applications embedded in Users.applications into the Applications collection
+        """
+        print(f"Migrated {migrate_applications()} applications")
+
+    @app.cli.command("normalize-application-dates")
+    def normalize_application_dates_command():
+        """
+        Zero pads the dates of stored applications to YYYY-MM-DD
+        """
+        print(f"Normalized {normalize_application_dates()} application dates")
+
+    @app.cli.command("index-applications")
+    def index_applications_command():
+        """
+        Builds the search terms of applications stored without them
+        """
+        print(f"Indexed {index_applications()} applications")
+
+    @app.cli.command("sync-indexes")
+    def sync_indexes_command():
+        """
+        Creates the indexes declared by the models
+        """
+        try:
+            for model, missing in sync_indexes().items():
+                print(f"{model}: created {len(missing)} missing indexes")
+        except OperationFailure as err:
+            # the other models' indexes were built, only the failing one is missing
+            for field, values in duplicate_users().items():
+                for value, ids in values.items():
+                    print(f"Users {ids} share the {field} {value!r}")
+            raise click.ClickException(
+                f"Could not create every index: {err}. Rename or merge the users "
+                "listed above, then run `flask sync-indexes` again")
+
+    @app.cli.command("invalidate-search-cache")
+    @click.argument("keywords", required=False)
+    def invalidate_search_cache_command(keywords):
+        """
+        Removes the cached /search insights of KEYWORDS, or all of them
+        """
+        print(f"Removed {insight_cache.invalidate(keywords)} cached searches")
+
+    @app.cli.command("recommendation-worker")
+    @click.option("--workers", default=2, help="Number of refreshes run at the same time")
+    def recommendation_worker_command(workers):
+        """
+        Runs queued recommendation refreshes until interrupted
+        """
+        RecommendationWorker(llm, workers=workers).serve()
 
-        except Exception as e:
-            print(f"Error comparing resume: {str(e)}")
-            return jsonify({"error": "Failed to compare resume"}), 500
-    
-        
-    @app.errorhandler(404)
-    def page_not_found(error):  # Add error parameter
+    @app.cli.command("migrate-analyses")
+    def migrate_analyses_command():
         """
-        Returns a json object to indicate error 404
+        Moves the analyses embedded in Users.analyses into the Analyses collection
+        """
+        print(f"Migrated {migrate_analyses()} analyses")
 
-        :return: JSON object
+    @app.cli.command("dedupe-analyses")
+    def dedupe_analyses_command():
         """
-        return jsonify({"error": "Not Found"}), 404
+        Moves the insights embedded in saved analyses into the Insights collection
+        """
+        print(f"Deduplicated {dedupe_analyses()} analyses")
     
     @app.route("/analyses", methods=["GET"])
     def get_analyses():
         """
-        Gets user's saved analyses from the database
+        Gets user's saved analyses from the database. Without a limit every
+        analysis is returned as a list in the order it was saved. With a limit
+        one page of the newest analyses is returned together with the cursor to
+        pass as "after" for the next page. summary=1 leaves out the insights
+
+        :return: JSON object with the analyses
         """
         try:
-            userid = get_userid_from_header()
-            user = Users.objects(id=userid).first()
-            
-            if not hasattr(user, 'analyses'):
-                return jsonify([])
-                
-            return jsonify(user.analyses)
+            userid = int(get_userid_from_header())
+            query = {"userId": userid}
+            after = request.args.get("after")
+            if after:
+                try:
+                    created_at, last_id = decode_cursor(after)
+                    created_at = datetime.fromisoformat(created_at)
+                    last_id = ObjectId(last_id)
+                except:
+                    return jsonify({"error": "Invalid cursor"}), 400
+                query["$or"] = [
+                    {"createdAt": {"$lt": created_at}},
+                    {"createdAt": created_at, "_id": {"$lt": last_id}},
+                ]
+            projection = {"userId": 0}
+            if request.args.get("summary") in ("1", "true"):
+                projection["insights"] = 0
+                projection["insightsRef"] = 0
+
+            collection = Analyses._get_collection()
+            limit = request.args.get("limit", type=int)
+            if limit is None:
+                cursor = collection.find(query, projection).sort(
+                    [("createdAt", 1), ("_id", 1)])
+                return jsonify(hydrate_insights([analysis_to_json(a) for a in cursor]))
+
+            limit = max(1, min(limit, MAX_PAGE_SIZE))
+            analyses = list(collection.find(query, projection).sort(
+                [("createdAt", -1), ("_id", -1)]).limit(limit + 1))
+            next_cursor = None
+            if len(analyses) > limit:
+                analyses = analyses[:limit]
+                last = analyses[-1]
+                next_cursor = encode_cursor(
+                    [last["createdAt"].isoformat(), str(last["_id"])])
+            return jsonify({
+                "analyses": hydrate_insights([analysis_to_json(a) for a in analyses]),
+                "next": next_cursor,
+            })
         except Exception as e:
             print(f"Error getting analyses: {str(e)}")
             return jsonify({"error": "Internal server error"}), 500
 
+    @app.route("/analyses/export", methods=["GET"])
+    def export_analyses():
+        """
+        Streams the user's saved analyses as CSV or NDJSON
+
+        :return: streamed response with the analyses
+        """
+        try:
+            userid = int(get_userid_from_header())
+            file_format = request.args.get("format", "csv").lower()
+            if file_format not in EXPORT_FORMATS:
+                return jsonify({"error": "Format must be csv or ndjson"}), 400
+
+            cursor = hydrate_insights_in_batches((
+                analysis_to_json(a) for a in Analyses._get_collection().find(
+                    {"userId": userid}, {"userId": 0}
+                ).sort([("createdAt", 1), ("_id", 1)]).batch_size(EXPORT_BATCH_SIZE)
+            ), EXPORT_BATCH_SIZE)
+            if file_format == "csv":
+                rows = stream_csv(ANALYSIS_EXPORT_COLUMNS, (
+                    [a.get("id"), a.get("searchTerm"), a.get("date"),
+                     (a.get("comparison") or {}).get("overallMatch"),
+                     json.dumps(a.get("comparison")), json.dumps(a.get("insights"))]
+                    for a in cursor
+                ))
+            else:
+                rows = stream_ndjson(cursor)
+            return export_response(rows, file_format, "analyses")
+        except:
+            return jsonify({"error": "Internal server error"}), 500
+
     @app.route("/analyses", methods=["POST"]) 
     def save_analysis():
         """
-        Saves a new analysis to the user's profile
+        Saves a new analysis to the user's profile. When ANALYSES_RETENTION is
+        set only that many of the newest analyses are kept
         """
         try:
-            userid = get_userid_from_header()
-            user = Users.objects(id=userid).first()
-            
+            userid = int(get_userid_from_header())
             analysis = json.loads(request.data)
-            
-            if not hasattr(user, 'analyses'):
-                user.analyses = []
-                
-            user.analyses.append(analysis)
-            user.save()
-            
+            if not isinstance(analysis, dict):
+                return jsonify({"error": "Analysis must be an object"}), 400
+            for key in ("_id", "userId", "createdAt"):
+                analysis.pop(key, None)
+
+            Analyses._get_collection().insert_one({
+                **store_analysis_insights(analysis),
+                "userId": userid,
+                "createdAt": datetime.utcnow(),
+            })
+            if analyses_retention:
+                prune_analyses(userid, analyses_retention)
+
             return jsonify({"message": "Analysis saved successfully"}), 200
         except Exception as e:
             print(f"Error saving analysis: {str(e)}")
@@ -1140,13 +2494,12 @@ def create_app():
         The file should be sent with the form field 'profilePhoto'.
         """
         try:
-            userid = get_userid_from_header()
             try:
                 file = request.files["profilePhoto"]
             except:
                 return jsonify({"error": "No profile photo file found in the input"}), 400
 
-            user = Users.objects(id=userid).first()
+            user = get_current_user("profilePhoto")
             try:
                 if not user.profilePhoto.read():
                     user.profilePhoto.put(file, filename=file.filename, content_type=file.content_type)
@@ -1171,8 +2524,7 @@ def create_app():
         The returned URL points to the '/profilePhoto/file' endpoint.
         """
         try:
-            userid = get_userid_from_header()
-            user = Users.objects(id=userid).first()
+            user = get_current_user("profilePhoto")
             if not user.profilePhoto or not user.profilePhoto.read():
                 return jsonify({"error": "No profile photo found"}), 404
             user.profilePhoto.seek(0)
@@ -1194,8 +2546,7 @@ def create_app():
         Serves the actual profile photo file.
         """
         try:
-            userid = get_userid_from_header()
-            user = Users.objects(id=userid).first()
+            user = get_current_user("profilePhoto")
             if not user.profilePhoto or not user.profilePhoto.read():
                 return jsonify({"error": "No profile photo found"}), 404
             user.profilePhoto.seek(0)
@@ -1252,9 +2603,9 @@ class Users(db.Document):
     fullName = db.StringField()
     username = db.StringField()
     password = db.StringField()
-    authTokens = db.ListField()
+    authTokens = db.ListField()  # legacy, see migrate_auth_tokens
     email = db.StringField()
-    applications = db.ListField()
+    applications = db.ListField()  # legacy, see migrate_applications
     resume = db.FileField()
     skills = db.ListField()
     job_levels = db.ListField()
@@ -1262,9 +2613,30 @@ class Users(db.Document):
     institution = db.StringField()
     phone_number = db.StringField()
     address = db.StringField()
-    analyses = db.ListField()  # Add analyses field
+    analyses = db.ListField()  # legacy, see migrate_analyses
+    applicationSeq = db.IntField()  # last application id handed out
     profilePhoto = db.FileField()
 
+    meta = {
+        "indexes": [
+            # users created through Google have no username and password users
+            # may have no email, so both are only unique where they are set.
+            # $gt "" only matches non-empty strings, which an equality lookup
+            # on a string implies, so the handlers' queries can use the indexes
+            {
+                "fields": ["username"],
+                "unique": True,
+                "partialFilterExpression": {"username": {"$gt": ""}},
+            },
+            {
+                "fields": ["email"],
+                "unique": True,
+                "partialFilterExpression": {"email": {"$gt": ""}},
+            },
+        ],
+        "auto_create_index": False,
+    }
+
     def to_json(self):
         """
         Returns the user details in JSON object
@@ -1274,40 +2646,1037 @@ class Users(db.Document):
         return {"id": self.id, "fullName": self.fullName, "username": self.username}
 
 
+class AuthTokens(db.Document):
+    """
+    AuthTokens class. Holds a login token, the user it belongs to and its expiry.
+    Expired tokens are removed by Mongo through the TTL index on expiry
+    """
+    token = db.StringField(required=True, unique=True)
+    userId = db.IntField(required=True)
+    expiry = db.DateTimeField(required=True)  # UTC
+
+    meta = {
+        "indexes": [
+            "userId",
+            {"fields": ["expiry"], "expireAfterSeconds": 0},
+        ],
+        "auto_create_index": False,
+    }
+
+
+class RevokedTokens(db.Document):
+    """
+    RevokedTokens class. Holds the signatures of revoked signed tokens until they expire
+    """
+    signature = db.StringField(primary_key=True)
+    expiry = db.DateTimeField(required=True)  # UTC
+
+    meta = {
+        "indexes": [{"fields": ["expiry"], "expireAfterSeconds": 0}],
+        "auto_create_index": False,
+    }
+
+
+def issue_auth_token(user_id, token, lifetime=timedelta(days=1)):
+    """
+    Stores a new authorization token for the user
+
+    :param user_id: user id of the token owner
+    :param token: token to be stored
+    :param lifetime: how long the token stays valid
+    :return: expiry of the token formatted for the client
+    """
+    AuthTokens(
+        token=token, userId=user_id, expiry=datetime.utcnow() + lifetime
+    ).save(force_insert=True)
+    return (datetime.now() + lifetime).strftime("%m/%d/%Y, %H:%M:%S")
+
+
+def migrate_auth_tokens():
+    """
+    Moves the tokens embedded in Users.authTokens into the AuthTokens collection.
+    Tokens that already expired are dropped
+
+    :return: number of tokens migrated
+    """
+    utc_offset = datetime.utcnow() - datetime.now()
+    migrated = 0
+    for user in Users.objects(authTokens__0__exists=True).only("id", "authTokens"):
+        for entry in user.authTokens:
+            expiry = datetime.strptime(
+                entry["expiry"], "%m/%d/%Y, %H:%M:%S") + utc_offset
+            if expiry <= datetime.utcnow():
+                continue
+            AuthTokens.objects(token=entry["token"]).update_one(
+                upsert=True, set__userId=user.id, set__expiry=expiry
+            )
+            migrated += 1
+        user.update(unset__authTokens=True)
+    return migrated
+
+
+class Counters(db.Document):
+    """
+    Counters class. Holds named sequences that are handed out atomically
+    """
+    name = db.StringField(primary_key=True)
+    seq = db.IntField(default=0)
+
+    meta = {"auto_create_index": False}
+
+
+def get_next_sequence(name, model=None, field="id"):
+    """
+    Atomically increments and returns the named sequence. On first use the
+    sequence is seeded from the current maximum of the given field of the model
+
+    :param name: name of the sequence
+    :param model: document class the sequence hands out ids for
+    :param field: field of the model holding the ids
+    :return: next value of the sequence
+    """
+    counters = Counters._get_collection()
+    counter = counters.find_one_and_update(
+        {"_id": name}, {"$inc": {"seq": 1}}, return_document=ReturnDocument.AFTER
+    )
+    if counter is None:
+        seed = 0
+        if model is not None:
+            latest = model.objects.order_by(f"-{field}").only(field).first()
+            if latest is not None:
+                seed = latest[field]
+        # $max keeps seeding idempotent when several workers race on first use
+        counters.update_one({"_id": name}, {"$max": {"seq": seed}}, upsert=True)
+        counter = counters.find_one_and_update(
+            {"_id": name}, {"$inc": {"seq": 1}}, return_document=ReturnDocument.AFTER
+        )
+    return counter["seq"]
+
+
 def get_new_user_id():
     """
     Returns the next value to be used for new user
 
     :return: key with new user_id
     """
-    user_objects = Users.objects()
-    if len(user_objects) == 0:
-        return 1
+    return get_next_sequence("users", Users)
+
+
+def find_or_create_google_user(email, full_name):
+    """
+    Returns the id of the user with the given email, creating the user on first
+    sign-in. Returning users cost a single indexed read and never touch the
+    users counter; an id is only allocated on the insert path, and the unique
+    email index turns a race between two first sign-ins into a retry of the read
+
+    :param email: verified email of the Google account
+    :param full_name: name of the Google account
+    :return: user id
+    """
+    collection = Users._get_collection()
+    user = collection.find_one({"email": email}, {"_id": 1})
+    if user is not None:
+        return user["_id"]
+    user_id = get_new_user_id()
+    try:
+        collection.insert_one({
+            "_id": user_id,
+            "email": email,
+            "fullName": full_name,
+            "skills": [],
+            "job_levels": [],
+            "locations": [],
+            "phone_number": "",
+            "address": "",
+        })
+    except DuplicateKeyError:
+        # another sign-in created the user first, its id wins
+        return collection.find_one({"email": email}, {"_id": 1})["_id"]
+    return user_id
+
+
+class Applications(db.DynamicDocument):
+    """
+    Applications class. Holds one job application tracked by a user. Fields
+    other than the declared ones can be added through the update endpoint
+    """
+    userId = db.IntField(required=True)
+    applicationId = db.IntField(required=True, db_field="id")
+    jobTitle = db.StringField()
+    companyName = db.StringField()
+    date = db.StringField()
+    jobLink = db.StringField()
+    location = db.StringField()
+    status = db.StringField()
+    searchTerms = db.ListField(db.StringField())
+
+    meta = {
+        "indexes": [
+            {"fields": ["userId", "applicationId"], "unique": True},
+            ["userId", "searchTerms"],
+            ["userId", "date", "applicationId"],
+            ["userId", "status", "applicationId"],
+            ["userId", "status", "date", "applicationId"],
+            ["userId", "companyName", "applicationId"],
+        ],
+        "auto_create_index": False,
+    }
+
+
+# embedded lists kept on Users only until their migrations have run
+LEGACY_USER_FIELDS = ("applications", "authTokens", "analyses")
+PROFILE_FIELDS = (
+    "skills",
+    "job_levels",
+    "locations",
+    "institution",
+    "phone_number",
+    "address",
+    "email",
+    "fullName",
+)
+
+PROFILE_LIST_FIELDS = ("skills", "job_levels", "locations")
+# sent back by the client with the rest of the profile but never written
+READ_ONLY_PROFILE_FIELDS = ("id", "username", "profilePhoto")
+MAX_PROFILE_STRING_LENGTH = 500
+MAX_PROFILE_LIST_LENGTH = 100
+
+
+def validate_profile_update(data):
+    """
+    Validates a profile update against the writable profile fields
+
+    :param data: dictionary sent by the client
+    :return: dictionary of the fields to be set
+    """
+    if not isinstance(data, dict):
+        raise ValueError("Profile must be an object")
+    changes = {}
+    for key, value in data.items():
+        if key in READ_ONLY_PROFILE_FIELDS:
+            continue
+        if key not in PROFILE_FIELDS:
+            raise ValueError(f"Unknown field {key}")
+        if key in PROFILE_LIST_FIELDS:
+            if not isinstance(value, list) or len(value) > MAX_PROFILE_LIST_LENGTH:
+                raise ValueError(f"Invalid value for {key}")
+            for option in value:
+                if not isinstance(option, dict) or not isinstance(option.get("value"), str):
+                    raise ValueError(f"Invalid value for {key}")
+            value = [
+                {k: v for k, v in option.items() if k in ("label", "value")}
+                for option in value
+            ]
+        elif value is not None and (
+            not isinstance(value, str) or len(value) > MAX_PROFILE_STRING_LENGTH
+        ):
+            raise ValueError(f"Invalid value for {key}")
+        changes[key] = value
+    if not changes:
+        raise ValueError("No fields found in input")
+    return changes
+
+
+# fields returned to the client for an application
+APPLICATION_PROJECTION = {"_id": 0, "userId": 0, "searchTerms": 0}
+APPLICATION_SORT_FIELDS = {"id", "date", "status"}
+MAX_PAGE_SIZE = 500
+DATE_PATTERN = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+# attempts at an application update that raced with another edit
+MAX_UPDATE_ATTEMPTS = 3
+FIELD_NAME_PATTERN = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+
+def allocate_application_ids(user_id, count=1):
+    """
+    Atomically reserves consecutive application ids from the user's sequence
+
+    :param user_id: user id of the active user
+    :param count: number of ids to reserve
+    :return: first reserved id, or None if the user does not exist
+    """
+    user = Users._get_collection().find_one_and_update(
+        {"_id": int(user_id)},
+        {"$inc": {"applicationSeq": count}},
+        projection={"applicationSeq": 1},
+        return_document=ReturnDocument.AFTER,
+    )
+    if user is None:
+        return None
+    return user["applicationSeq"] - count + 1
+
+
+class Analyses(db.DynamicDocument):
+    """
+    Analyses class. Holds one resume analysis saved by a user, with the
+    fields sent by the client stored as they are
+    """
+    userId = db.IntField(required=True)
+    createdAt = db.DateTimeField(required=True)
+    analysisId = db.DynamicField(db_field="id")
+
+    meta = {"indexes": [["userId", "-createdAt", "-id"]], "auto_create_index": False}
+
+
+def analysis_to_json(analysis):
+    """
+    Converts a stored analysis into the shape sent to the client
+
+    :param analysis: dictionary read from the Analyses collection
+    :return: dictionary
+    """
+    analysis.pop("_id", None)
+    analysis.pop("userId", None)
+    if isinstance(analysis.get("createdAt"), datetime):
+        analysis["createdAt"] = analysis["createdAt"].isoformat()
+    return analysis
+
+
+class Insights(db.Document):
+    """
+    Insights class. Holds one role insights document under the hash of its
+    normalized JSON, so that analyses of the same insights share one copy
+    """
+    key = db.StringField(primary_key=True)
+    insights = db.DictField()
+    createdAt = db.DateTimeField()
+
+    meta = {"auto_create_index": False}
+
+
+# profile fields the job recommendations depend on
+RECOMMENDATION_FIELDS = ("skills", "job_levels", "locations")
+
+
+class Recommendations(db.Document):
+    """
+    Recommendations class. Holds the last job recommendations generated for a
+    user and a hash of the preferences they were generated for
+    """
+    userId = db.IntField(primary_key=True)
+    jobs = db.ListField()
+    preferencesKey = db.StringField()
+    requestedAt = db.DateTimeField()
+    updatedAt = db.DateTimeField()
+
+    meta = {"auto_create_index": False}
+
+
+class RecommendationJobs(db.Document):
+    """
+    RecommendationJobs class. Holds the queued or running refresh of a user's
+    recommendations, see RecommendationWorker
+    """
+    userId = db.IntField(primary_key=True)
+    status = db.StringField()
+    force = db.BooleanField()
+    dirty = db.BooleanField()
+    claim = db.StringField()
+    attempts = db.IntField()
+    enqueuedAt = db.DateTimeField()
+    runAfter = db.DateTimeField()
+    startedAt = db.DateTimeField()
+
+    meta = {
+        "indexes": [["status", "runAfter"], ["status", "startedAt"]],
+        "auto_create_index": False,
+    }
+
+
+def preferences_key(preferences):
+    """
+    Returns a hash of the preferences the recommendations depend on
+
+    :param preferences: dictionary with skills, job_levels and locations
+    :return: hex encoded SHA-256
+    """
+    values = [
+        sorted(option.get("value", "") for option in preferences.get(field) or [])
+        for field in RECOMMENDATION_FIELDS
+    ]
+    return hashlib.sha256(json.dumps(values).encode()).hexdigest()
+
+
+def store_recommendations(user_id, jobs, key, requested_at):
+    """
+    Stores the recommendations generated for a user, unless recommendations
+    requested later were stored already
+
+    :param user_id: user id
+    :param jobs: list of formatted jobs
+    :param key: preferences_key of the preferences used
+    :param requested_at: time the refresh was requested
+    :return: whether the recommendations were stored
+    """
+    try:
+        Recommendations._get_collection().replace_one(
+            {"_id": user_id, "requestedAt": {"$lt": requested_at}},
+            {"jobs": jobs, "preferencesKey": key, "requestedAt": requested_at,
+             "updatedAt": datetime.utcnow()},
+            upsert=True,
+        )
+    except DuplicateKeyError:
+        return False
+    return True
+
+
+class CompletionFlights(db.Document):
+    """
+    CompletionFlights class. Holds an LLM call in flight in one worker, and its
+    result for a few seconds once published, see MongoFlightStore
+    """
+    key = db.StringField(primary_key=True)
+    result = db.DynamicField()
+    error = db.StringField()
+    expiresAt = db.DateTimeField()
+
+    meta = {
+        "indexes": [{"fields": ["expiresAt"], "expireAfterSeconds": 0}],
+        "auto_create_index": False,
+    }
+
+
+class CachedInsights(db.Document):
+    """
+    CachedInsights class. Holds the /search insights of one search until
+    expiresAt, when the TTL index removes them
+    """
+    key = db.StringField(primary_key=True)
+    keywords = db.StringField()
+    model = db.StringField()
+    promptVersion = db.StringField()
+    insights = db.DictField()
+    createdAt = db.DateTimeField()
+    expiresAt = db.DateTimeField()
+
+    meta = {
+        "indexes": [
+            "keywords",
+            {"fields": ["expiresAt"], "expireAfterSeconds": 0},
+        ],
+        "auto_create_index": False,
+    }
+
+
+def sync_indexes():
+    """
+    Creates the indexes declared by the models. Models do not create their
+    indexes on first use, so this runs once per deploy through
+    `flask sync-indexes`, which startup.sh and the API image run before the
+    server starts; indexes that already exist are left untouched.
+
+    The unique username and email indexes cannot be built while users share a
+    username or an email, see duplicate_users; the other models are still synced
+    and the first failure is raised afterwards
+
+    :return: dictionary of model name to the indexes that were missing
+    """
+    missing = {}
+    failure = None
+    for model in (Users, AuthTokens, RevokedTokens, Counters, Applications,
+                  Analyses, Insights, CachedInsights, CompletionFlights,
+                  Recommendations, RecommendationJobs):
+        missing[model.__name__] = model.compare_indexes()["missing"]
+        try:
+            model.ensure_indexes()
+        except OperationFailure as err:
+            failure = failure or err
+    if failure is not None:
+        raise failure
+    return missing
+
+
+def duplicate_users():
+    """
+    Finds the usernames and emails shared by several users, which keep the
+    unique indexes on Users from being built
+
+    :return: dictionary of field to {value: list of user ids}
+    """
+    duplicates = {}
+    for field in ("username", "email"):
+        groups = Users._get_collection().aggregate([
+            {"$match": {field: {"$gt": ""}}},
+            {"$group": {"_id": f"${field}", "ids": {"$push": "$_id"}, "count": {"$sum": 1}}},
+            {"$match": {"count": {"$gt": 1}}},
+        ])
+        duplicates[field] = {group["_id"]: group["ids"] for group in groups}
+    return duplicates
+
+
+def insights_key(insights):
+    """
+    Returns the content address of an insights document
+
+    :param insights: dictionary
+    :return: hex encoded SHA-256 of the normalized JSON
+    """
+    normalized = json.dumps(insights, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(normalized.encode()).hexdigest()
+
+
+def store_analysis_insights(analysis):
+    """
+    Stores the insights of an analysis in the Insights collection, once per
+    distinct document, and replaces them with a reference
+
+    :param analysis: dictionary sent by the client
+    :return: analysis holding insightsRef instead of insights
+    """
+    insights = analysis.get("insights")
+    if not isinstance(insights, dict):
+        return analysis
+    key = insights_key(insights)
+    Insights._get_collection().update_one(
+        {"_id": key},
+        {"$setOnInsert": {"insights": insights, "createdAt": datetime.utcnow()}},
+        upsert=True,
+    )
+    analysis = {k: v for k, v in analysis.items() if k != "insights"}
+    analysis["insightsRef"] = key
+    return analysis
+
+
+def hydrate_insights(analyses):
+    """
+    Replaces the insightsRef of each analysis with the referenced insights,
+    using one query for the whole list
+
+    :param analyses: list of analyses
+    :return: the same list
+    """
+    keys = {a["insightsRef"] for a in analyses if "insightsRef" in a}
+    if not keys:
+        return analyses
+    stored = {
+        document["_id"]: document["insights"]
+        for document in Insights._get_collection().find({"_id": {"$in": list(keys)}})
+    }
+    for analysis in analyses:
+        if "insightsRef" in analysis:
+            analysis["insights"] = stored.get(analysis.pop("insightsRef"))
+    return analyses
+
+
+def hydrate_insights_in_batches(analyses, batch_size):
+    """
+    Lazily hydrates a stream of analyses, one batch at a time
+
+    :param analyses: iterable of analyses
+    :param batch_size: number of analyses hydrated per query
+    :return: generator of analyses
+    """
+    batch = []
+    for analysis in analyses:
+        batch.append(analysis)
+        if len(batch) >= batch_size:
+            yield from hydrate_insights(batch)
+            batch = []
+    yield from hydrate_insights(batch)
+
+
+def dedupe_analyses():
+    """
+    Moves the insights embedded in already saved analyses into the Insights collection
+
+    :return: number of analyses updated
+    """
+    collection = Analyses._get_collection()
+    updated = 0
+    for analysis in collection.find({"insights": {"$type": "object"}}, {"insights": 1}):
+        reference = store_analysis_insights(analysis)["insightsRef"]
+        collection.update_one(
+            {"_id": analysis["_id"]},
+            {"$set": {"insightsRef": reference}, "$unset": {"insights": ""}},
+        )
+        updated += 1
+    return updated
+
+
+def prune_analyses(user_id, retention):
+    """
+    Deletes all but the newest analyses of the user
+
+    :param user_id: user id of the active user
+    :param retention: number of analyses to keep
+    """
+    collection = Analyses._get_collection()
+    oldest_kept = list(collection.find({"userId": user_id}, {"createdAt": 1}).sort(
+        [("createdAt", -1), ("_id", -1)]).skip(retention - 1).limit(1))
+    if oldest_kept:
+        collection.delete_many({"userId": user_id, "$or": [
+            {"createdAt": {"$lt": oldest_kept[0]["createdAt"]}},
+            {"createdAt": oldest_kept[0]["createdAt"], "_id": {"$lt": oldest_kept[0]["_id"]}},
+        ]})
+
+
+def migrate_analyses():
+    """
+    Moves the analyses embedded in Users.analyses into the Analyses collection,
+    keeping their order
+
+    :return: number of analyses migrated
+    """
+    collection = Analyses._get_collection()
+    migrated = 0
+    for user in Users.objects(analyses__0__exists=True).only("id", "analyses"):
+        # the saved order is all that is known about when embedded analyses were made
+        start = datetime.utcnow() - timedelta(milliseconds=len(user.analyses))
+        collection.insert_many([
+            {**store_analysis_insights(analysis), "userId": user.id,
+             "createdAt": start + timedelta(milliseconds=index)}
+            for index, analysis in enumerate(user.analyses)
+        ])
+        user.update(unset__analyses=True)
+        migrated += len(user.analyses)
+    return migrated
+
+
+IMPORT_FORMATS = {"csv", "ndjson", "jsonl"}
+IMPORT_BATCH_SIZE = 500
+MAX_REPORTED_ERRORS = 100
+
+
+def read_import_rows(stream, file_format):
+    """
+    Lazily parses an uploaded file into rows
+
+    :param stream: text stream of the uploaded file
+    :param file_format: "csv", "ndjson" or "jsonl"
+    :return: generator of (row number, row) tuples, where a row that could not be
+        parsed is a ValueError
+    """
+    if file_format == "csv":
+        for row_number, row in enumerate(csv.DictReader(stream), start=1):
+            yield row_number, row
+        return
+    for row_number, line in enumerate(stream, start=1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except json.JSONDecodeError as err:
+            row = ValueError(f"Invalid JSON: {err.msg}")
+        yield row_number, row
+
+
+def application_from_row(row):
+    """
+    Validates an imported row the same way add_application does and converts it
+    into an application. The "class" column of exported CSV files holds the status
+
+    :param row: dictionary parsed from the file, or the error raised while parsing it
+    :return: application without an id
+    """
+    if isinstance(row, ValueError):
+        raise row
+    if not isinstance(row, dict):
+        raise ValueError("Row must be an object")
+
+    def value(key):
+        item = row.get(key)
+        if isinstance(item, str):
+            item = item.strip()
+        return item if item not in ("", None) else None
+
+    job_title, company_name = value("jobTitle"), value("companyName")
+    if job_title is None or company_name is None:
+        raise ValueError("Missing fields in input")
+    status = value("status") or value("class") or "1"
+    return {
+        "jobTitle": job_title,
+        "companyName": company_name,
+        "date": normalize_date(value("date")),
+        "jobLink": value("jobLink"),
+        "location": value("location"),
+        "status": str(status),
+    }
+
+
+def insert_application_batch(user_id, batch):
+    """
+    Inserts a batch of imported applications with one bulk write, using a block
+    of ids reserved from the user's sequence
+
+    :param user_id: user id of the active user
+    :param batch: list of (row number, application) tuples
+    :return: number of inserted applications and the list of row errors
+    """
+    if not batch:
+        return 0, []
+    first_id = allocate_application_ids(user_id, len(batch))
+    documents = [
+        {"userId": user_id, "id": first_id + offset, **application,
+         "searchTerms": search_terms(application)}
+        for offset, (_, application) in enumerate(batch)
+    ]
+    try:
+        Applications._get_collection().insert_many(documents, ordered=False)
+    except BulkWriteError as err:
+        failed = [
+            {"row": batch[write_error["index"]][0], "error": write_error["errmsg"]}
+            for write_error in err.details["writeErrors"]
+        ]
+        return len(batch) - len(failed), failed
+    return len(batch), []
+
+
+EXPORT_FORMATS = {"csv", "ndjson"}
+EXPORT_BATCH_SIZE = 500
+APPLICATION_EXPORT_COLUMNS = ["jobTitle", "companyName", "date", "class", "id"]
+ANALYSIS_EXPORT_COLUMNS = [
+    "id", "searchTerm", "date", "overallMatch", "comparison", "insights"]
+
+
+def stream_csv(columns, rows):
+    """
+    Lazily renders rows as CSV lines
+
+    :param columns: header row
+    :param rows: iterable of lists of values
+    :return: generator of CSV lines
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    writer.writerow(columns)
+    yield buffer.getvalue()
+    for row in rows:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerow(row)
+        yield buffer.getvalue()
+
+
+def stream_ndjson(documents):
+    """
+    Lazily renders documents as newline delimited JSON
+
+    :param documents: iterable of dictionaries
+    :return: generator of JSON lines
+    """
+    for document in documents:
+        document.pop("_id", None)
+        yield json.dumps(document, default=str) + "\n"
+
+
+def export_response(rows, file_format, name):
+    """
+    Wraps a generator of rows into a streamed file download
 
-    new_id = 0
-    for a in user_objects:
-        new_id = max(new_id, a["id"])
+    :param rows: generator of CSV or NDJSON lines
+    :param file_format: "csv" or "ndjson"
+    :param name: base name of the downloaded file
+    :return: streamed response
+    """
+    mimetype = "text/csv" if file_format == "csv" else "application/x-ndjson"
+    response = Response(stream_with_context(rows), mimetype=mimetype)
+    response.headers["Content-Disposition"] = f"attachment; filename={name}.{file_format}"
+    return response
+
+
+def encode_cursor(values):
+    """
+    Encodes the sort key of the last returned item into an opaque cursor
+
+    :param values: list of JSON serializable values
+    :return: string
+    """
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def decode_cursor(cursor):
+    """
+    Decodes a cursor created by encode_cursor
+
+    :param cursor: string
+    :return: list of values
+    """
+    return json.loads(base64.urlsafe_b64decode(cursor.encode()))
+
+
+def normalize_date(value):
+    """
+    Zero pads an application date to YYYY-MM-DD, so that dates compare and sort
+    as strings; data/applications.csv writes them like 2021-9-22
+
+    :param value: date string, or None
+    :return: YYYY-MM-DD string, or None for a missing date
+    """
+    if value is None or (isinstance(value, str) and not value.strip()):
+        return None
+    try:
+        return datetime.strptime(value.strip(), "%Y-%m-%d").strftime("%Y-%m-%d")
+    except (TypeError, AttributeError, ValueError):
+        raise ValueError("Invalid date, expected YYYY-MM-DD")
+
+
+def normalize_application_dates():
+    """
+    Zero pads the dates of applications stored before dates were normalized.
+    Dates that cannot be parsed are left as they are
+
+    :return: number of applications updated
+    """
+    collection = Applications._get_collection()
+    operations = []
+    for application in collection.find({"date": {"$type": "string"}}, {"date": 1}):
+        try:
+            date = normalize_date(application["date"])
+        except ValueError:
+            continue
+        if date != application["date"]:
+            operations.append(UpdateOne({"_id": application["_id"]}, {"$set": {"date": date}}))
+    if operations:
+        collection.bulk_write(operations, ordered=False)
+    return len(operations)
+
+
+def application_filter(user_id, args):
+    """
+    Builds the query selecting the user's applications that match the filters
+    given in the request arguments
+
+    :param user_id: user id of the active user
+    :param args: request arguments with optional status, companyName, dateFrom and dateTo
+    :return: query dictionary
+    """
+    query = {"userId": user_id}
+    status = args.get("status")
+    if status:
+        query["status"] = {"$in": status.split(",")}
+    company_name = args.get("companyName")
+    if company_name:
+        # an anchored, case sensitive prefix can be answered from the index
+        query["companyName"] = {"$regex": "^" + re.escape(company_name)}
+    date_range = {}
+    for arg, op in (("dateFrom", "$gte"), ("dateTo", "$lte")):
+        if args.get(arg):
+            if not DATE_PATTERN.match(args[arg]):
+                raise ValueError(f"{arg} must be a YYYY-MM-DD date")
+            date_range[op] = normalize_date(args[arg])
+    if date_range:
+        query["date"] = date_range
+    return query
+
+
+# searchable fields and the weight of a match in each of them
+SEARCH_FIELDS = {"jobTitle": 3, "companyName": 2, "location": 1}
+SEARCH_TOKEN_PATTERN = re.compile(r"\w+")
+DEFAULT_SEARCH_LIMIT = 20
+MAX_SEARCH_TOKENS = 8
+MAX_SEARCH_CANDIDATES = 1000
+
+
+def tokenize(text):
+    """
+    Splits text into lower case words
+
+    :param text: string, or None
+    :return: list of words
+    """
+    if not isinstance(text, str):
+        return []
+    return SEARCH_TOKEN_PATTERN.findall(text.lower())
 
-    return new_id + 1
 
+def search_terms(application):
+    """
+    Returns the distinct words of the searchable fields of an application,
+    stored as a multikey array so that word prefixes are index range scans
+
+    :param application: application dictionary
+    :return: sorted list of words
+    """
+    return sorted({
+        term for field in SEARCH_FIELDS for term in tokenize(application.get(field))
+    })
+
+
+def search_score(application, tokens):
+    """
+    Ranks an application against the words of a query. Whole word matches score
+    twice as much as prefix matches and each field has its own weight
+
+    :param application: application dictionary
+    :param tokens: words of the query
+    :return: score, higher is better
+    """
+    score = 0
+    for field, weight in SEARCH_FIELDS.items():
+        terms = tokenize(application.get(field))
+        for token in tokens:
+            if token in terms:
+                score += 2 * weight
+            elif any(term.startswith(token) for term in terms):
+                score += weight
+    return score
+
+
+def index_applications():
+    """
+    Builds searchTerms for applications stored before search was added
+
+    :return: number of applications updated
+    """
+    collection = Applications._get_collection()
+    projection = {field: 1 for field in SEARCH_FIELDS}
+    operations = []
+    updated = 0
+    for application in collection.find({"searchTerms": {"$exists": False}}, projection):
+        operations.append(UpdateOne(
+            {"_id": application["_id"]},
+            {"$set": {"searchTerms": search_terms(application)}},
+        ))
+        if len(operations) >= IMPORT_BATCH_SIZE:
+            updated += collection.bulk_write(operations, ordered=False).modified_count
+            operations = []
+    if operations:
+        updated += collection.bulk_write(operations, ordered=False).modified_count
+    return updated
+
+
+DEFAULT_TOP_COMPANIES = 5
+MAX_TOP_COMPANIES = 50
+
+
+def date_part(parts, index):
+    """
+    Returns the expression reading a part of a split date, zero padded to two
+    digits, as the dates of data/applications.csv are written like 2021-9-22
+
+    :param parts: expression of the array of date parts
+    :param index: index of the part
+    :return: aggregation expression
+    """
+    part = {"$ifNull": [{"$arrayElemAt": [parts, index]}, ""]}
+    return {"$cond": [{"$eq": [{"$strLenCP": part}, 1]}, {"$concat": ["0", part]}, part]}
+
+
+def application_stats_pipeline(user_id, top):
+    """
+    Builds the aggregation behind GET /applications/stats. The leading $match
+    uses the (userId, ...) indexes and $facet computes every summary in one pass
+
+    :param user_id: user id of the active user
+    :param top: number of companies to return
+    :return: aggregation pipeline
+    """
+    count = {"$sum": 1}
+    return [
+        {"$match": {"userId": user_id}},
+        {"$facet": {
+            "total": [{"$count": "count"}],
+            "byStatus": [
+                # updates store whatever status is sent, JSON keys must be strings
+                {"$group": {"_id": {"$toString": {"$ifNull": ["$status", "unknown"]}},
+                            "count": count}},
+                {"$sort": {"_id": 1}},
+            ],
+            "byWeek": [
+                {"$project": {"day": {"$let": {
+                    "vars": {"parts": {"$split": [{"$ifNull": ["$date", ""]}, "-"]}},
+                    "in": {"$dateFromString": {
+                        "dateString": {"$concat": [
+                            date_part("$$parts", 0), "-",
+                            date_part("$$parts", 1), "-",
+                            date_part("$$parts", 2),
+                        ]},
+                        "format": "%Y-%m-%d", "onError": None, "onNull": None,
+                    }},
+                }}}},
+                {"$match": {"day": {"$ne": None}}},
+                {"$group": {
+                    "_id": {"year": {"$isoWeekYear": "$day"}, "week": {"$isoWeek": "$day"}},
+                    "count": count,
+                }},
+                {"$sort": {"_id.year": 1, "_id.week": 1}},
+            ],
+            "topCompanies": [
+                {"$match": {"companyName": {"$nin": [None, ""]}}},
+                {"$group": {"_id": "$companyName", "count": count}},
+                {"$sort": {"count": -1, "_id": 1}},
+                {"$limit": top},
+            ],
+        }},
+    ]
 
-def get_new_application_id(user_id):
+
+def parse_fields(fields):
     """
-    Returns the next value to be used for new application
+    Parses a comma separated list of field names to project
 
-    :param: user_id: User id of the active user
-    :return: key with new application_id
+    :param fields: string such as "id,jobTitle,status", or None
+    :return: set of field names, empty when every field is requested
     """
-    user = Users.objects(id=user_id).first()
+    if not fields:
+        return set()
+    names = {name.strip() for name in fields.split(",") if name.strip()}
+    for name in names:
+        if not FIELD_NAME_PATTERN.match(name) or name in ("userId", "searchTerms"):
+            raise ValueError(f"Invalid field {name}")
+    return names
+
 
-    if len(user["applications"]) == 0:
-        return 1
+def application_page_filter(field, value, last_id, descending):
+    """
+    Returns the query selecting the applications that sort after the given
+    (field, id) position, so that pages are read from the index without skips
+
+    :param field: field the applications are sorted on
+    :param value: value of the field on the last returned application
+    :param last_id: id of the last returned application
+    :param descending: whether the sort order is descending
+    :return: query dictionary
+    """
+    op = "$lt" if descending else "$gt"
+    if field == "id":
+        return {"id": {op: last_id}}
+    if value is None:
+        # missing values sort before every other value
+        if descending:
+            return {field: None, "id": {op: last_id}}
+        return {"$or": [{field: {"$ne": None}}, {field: None, "id": {op: last_id}}]}
+    return {"$or": [{field: {op: value}}, {field: value, "id": {op: last_id}}]}
+
+
+def migrate_applications():
+    """
+    Moves the applications embedded in Users.applications into the Applications
+    collection and seeds each user's applicationSeq from the migrated ids
 
-    new_id = 0
-    for a in user["applications"]:
-        new_id = max(new_id, a["id"])
+    :return: number of applications migrated
+    """
+    collection = Applications._get_collection()
+    migrated = 0
+    for user in Users.objects(applications__0__exists=True).only(
+            "id", "applications", "applicationSeq"):
+        last_id = max([a["id"] for a in user.applications if "id" in a] + [0])
+        operations = []
+        for application in user.applications:
+            if "id" not in application:
+                last_id += 1
+                application = {**application, "id": last_id}
+            if application.get("date"):
+                try:
+                    application = {**application, "date": normalize_date(application["date"])}
+                except ValueError:
+                    # keep what the user typed rather than losing it
+                    pass
+            operations.append(ReplaceOne(
+                {"userId": user.id, "id": application["id"]},
+                {"userId": user.id, **application,
+                 "searchTerms": search_terms(application)},
+                upsert=True,
+            ))
+        collection.bulk_write(operations, ordered=False)
+        Users._get_collection().update_one(
+            {"_id": user.id},
+            {"$max": {"applicationSeq": last_id}, "$unset": {"applications": ""}},
+        )
+        migrated += len(operations)
+    return migrated
 
-    return new_id + 1
 
 # def build_preflight_response():
     # response = make_response()
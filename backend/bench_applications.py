@@ -0,0 +1,67 @@
+"""
+Benchmark for the application endpoints
+
+Measures the latency of adding, updating and deleting an application for a
+user with a growing number of tracked applications. Run from the backend
+folder against a test database configured in application.yml:
+
+    python bench_applications.py
+"""
+import time
+import uuid
+from statistics import median
+
+from app import app, Applications, Users, get_new_user_id, issue_auth_token
+
+SIZES = [10, 100, 1000, 10000]
+ROUNDS = 20
+
+
+def timed(call):
+    """
+    Returns the median latency of the call in milliseconds
+
+    :param call: function issuing one request
+    :return: float
+    """
+    samples = []
+    for _ in range(ROUNDS):
+        start = time.perf_counter()
+        call()
+        samples.append((time.perf_counter() - start) * 1000)
+    return median(samples)
+
+
+def main():
+    client = app.test_client()
+    user = Users(id=get_new_user_id(), username=f"bench-{uuid.uuid4()}", fullName="bench")
+    user.save()
+    token = f"{user.id}.{uuid.uuid4()}"
+    issue_auth_token(user.id, token)
+    header = {"Authorization": "Bearer " + token}
+    application = {"jobTitle": "Software Engineer", "companyName": "Bench", "status": "1"}
+
+    print(f"{'applications':>12} {'POST ms':>10} {'PUT ms':>10} {'DELETE ms':>10}")
+    try:
+        for size in SIZES:
+            Applications.objects(userId=user.id).delete()
+            Applications._get_collection().insert_many(
+                [{"userId": user.id, "id": i, **application} for i in range(1, size + 1)])
+            user.update(applicationSeq=size)
+            post = timed(lambda: client.post(
+                "/applications", headers=header, json={"application": application}))
+            put = timed(lambda: client.put(
+                f"/applications/{size // 2}", headers=header,
+                json={"application": {"status": "2"}}))
+            # each round deletes one of the applications added by the POST rounds
+            added = iter(range(size + 1, size + ROUNDS + 1))
+            delete = timed(lambda: client.delete(
+                f"/applications/{next(added)}", headers=header))
+            print(f"{size:>12} {post:>10.2f} {put:>10.2f} {delete:>10.2f}")
+    finally:
+        Applications.objects(userId=user.id).delete()
+        user.delete()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,396 @@
+"""
+Client for the chat completion API behind the AI features of the program
+"""
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+DEFAULT_URL = "https://api.openai.com/v1/chat/completions"
+DEFAULT_MODEL = "gpt-3.5-turbo"
+# rate limited or failing upstream, worth another attempt
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class LLMError(Exception):
+    """
+    Raised when the completion API does not return a usable answer
+    """
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key: the first caller runs the
+    call and the others wait for and share its result or error. With a store,
+    the first caller of each worker also has to claim the key in the store, and
+    workers that lose the claim wait for the result the winner publishes there
+    """
+
+    def __init__(self, store=None, wait_timeout=90):
+        """
+        :param store: optional cross-worker store with claim, wait and publish methods
+        :param wait_timeout: seconds to wait for another worker before calling anyway
+        """
+        self.store = store
+        self.wait_timeout = wait_timeout
+        self.coalesced = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        """
+        Runs fn once for all concurrent callers of the same key
+
+        :param key: key identifying identical calls
+        :param fn: function without arguments
+        :return: result of fn
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = {"done": threading.Event()}
+            else:
+                self.coalesced += 1
+        if not leader:
+            call["done"].wait()
+            if "error" in call:
+                raise call["error"]
+            return call["result"]
+        try:
+            call["result"] = self._lead(key, fn)
+            return call["result"]
+        except Exception as err:
+            call["error"] = err
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call["done"].set()
+
+    def _lead(self, key, fn):
+        if self.store is None:
+            return fn()
+        # the store only saves calls, a failing database must not fail the completion
+        try:
+            claimed = self.store.claim(key)
+        except Exception as err:
+            print(f"Could not claim a completion in the flight store: {err}")
+            return fn()
+        if not claimed:
+            try:
+                found, result, error = self.store.wait(key, self.wait_timeout)
+            except Exception as err:
+                print(f"Could not wait for a completion in the flight store: {err}")
+                return fn()
+            if not found:
+                # the other worker gave up or is too slow, call on our own
+                return fn()
+            if error is not None:
+                raise LLMError(error)
+            with self._lock:
+                self.coalesced += 1
+            return result
+        try:
+            result = fn()
+        except Exception as err:
+            self._publish(key, error=str(err))
+            raise
+        self._publish(key, result=result)
+        return result
+
+    def _publish(self, key, **outcome):
+        try:
+            self.store.publish(key, **outcome)
+        except Exception as err:
+            # waiting workers time out and call on their own
+            print(f"Could not publish a completion to the flight store: {err}")
+
+
+class LLMClient:
+    """
+    Sends chat completions over a pooled keep-alive session. Connection errors
+    and 429/5xx answers are retried a bounded number of times with jittered
+    exponential backoff; every request has a connect and a read timeout.
+    Identical concurrent completions are sent once, see SingleFlight
+    """
+
+    def __init__(self, url=DEFAULT_URL, model=DEFAULT_MODEL, api_key=None,
+                 connect_timeout=5, read_timeout=60, max_retries=2,
+                 backoff=0.5, max_backoff=8, pool_size=10, single_flight=None):
+        """
+        :param url: chat completions endpoint, e.g. a local stub in tests
+        :param model: model used when a call does not name one
+        :param api_key: API key, read from OPENAI_API_KEY when not given
+        :param connect_timeout: seconds to wait for a connection
+        :param read_timeout: seconds to wait for the answer
+        :param max_retries: attempts made after the first one
+        :param backoff: base delay in seconds between attempts
+        :param max_backoff: upper bound of the delay between attempts
+        :param pool_size: number of connections kept open to the endpoint
+        :param single_flight: SingleFlight coalescing identical completions
+        """
+        self.url = url
+        self.model = model
+        self.api_key = api_key
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.single_flight = single_flight or SingleFlight()
+
+    def complete(self, messages, temperature=0.7, json_mode=True, model=None):
+        """
+        Returns the content of the first choice of a chat completion
+
+        :param messages: list of chat messages
+        :param temperature: sampling temperature
+        :param json_mode: whether to ask the API for a JSON object
+        :param model: model to use instead of the default one
+        :return: content string
+        """
+        payload = {
+            "model": model or self.model,
+            "messages": messages,
+            "temperature": temperature,
+        }
+        if json_mode:
+            payload["response_format"] = {"type": "json_object"}
+        return self.single_flight.do(fingerprint(self.url, payload),
+                                     lambda: self._content(payload))
+
+    def stream(self, messages, temperature=0.7, json_mode=True, model=None):
+        """
+        Streams the content of a chat completion as the model produces it.
+        Retries only happen before the first delta; streams are not coalesced
+
+        :param messages: list of chat messages
+        :param temperature: sampling temperature
+        :param json_mode: whether to ask the API for a JSON object
+        :param model: model to use instead of the default one
+        :return: generator of content deltas
+        """
+        payload = {
+            "model": model or self.model,
+            "messages": messages,
+            "temperature": temperature,
+            "stream": True,
+        }
+        if json_mode:
+            payload["response_format"] = {"type": "json_object"}
+        response = self._post(payload, stream=True)
+        with response:
+            try:
+                for line in response.iter_lines():
+                    line = line.decode("utf-8")
+                    if not line.startswith("data:"):
+                        continue
+                    data = line[5:].strip()
+                    if data == "[DONE]":
+                        return
+                    try:
+                        delta = json.loads(data)["choices"][0]["delta"].get("content")
+                    except (KeyError, IndexError, TypeError, ValueError) as err:
+                        raise LLMError(f"Malformed completion chunk: {err!r}")
+                    if delta:
+                        yield delta
+            except requests.exceptions.RequestException as err:
+                raise LLMError(f"Completion stream failed: {err}")
+
+    def _content(self, payload):
+        try:
+            return self._post(payload)["choices"][0]["message"]["content"]
+        except (KeyError, IndexError, TypeError, ValueError) as err:
+            raise LLMError(f"Malformed completion: {err!r}")
+
+    def complete_json(self, system, prompt, temperature=0.7, json_mode=True, model=None):
+        """
+        Sends a system and a user message and parses the answer as JSON
+
+        :param system: system message
+        :param prompt: user message
+        :param temperature: sampling temperature
+        :param json_mode: whether to ask the API for a JSON object
+        :param model: model to use instead of the default one
+        :return: parsed JSON value
+        """
+        content = self.complete(
+            [{"role": "system", "content": system}, {"role": "user", "content": prompt}],
+            temperature=temperature, json_mode=json_mode, model=model,
+        )
+        return parse_json_content(content)
+
+    def _post(self, payload, stream=False):
+        headers = {
+            "Authorization": f"Bearer {self.api_key or os.getenv('OPENAI_API_KEY')}",
+            "Content-Type": "application/json",
+        }
+        for attempt in range(self.max_retries + 1):
+            last = attempt == self.max_retries
+            try:
+                response = self.session.post(
+                    self.url, headers=headers, json=payload, timeout=self.timeout,
+                    stream=stream)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as err:
+                # read timeouts are not retried, the upstream is already slow
+                if last or isinstance(err, requests.exceptions.ReadTimeout):
+                    raise LLMError(f"Completion request failed: {err}")
+                time.sleep(self._delay(attempt))
+                continue
+            if response.status_code == 200:
+                return response if stream else response.json()
+            response.close()
+            if response.status_code not in RETRY_STATUSES or last:
+                raise LLMError(
+                    f"Completion API answered {response.status_code}: {response.text[:200]}")
+            time.sleep(self._delay(attempt, response.headers.get("Retry-After")))
+
+    def _delay(self, attempt, retry_after=None):
+        try:
+            return min(float(retry_after), self.max_backoff)
+        except (TypeError, ValueError):
+            # full jitter keeps workers that failed together from retrying together
+            return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+
+class IncrementalJSONParser:
+    """
+    Parses a JSON object while its text arrives in pieces. Each member of the
+    top-level object is reported as soon as its value is closed, and so is each
+    element of the top-level arrays named in item_keys, so that clients can
+    show the first sections of a completion long before the last ones exist
+    """
+
+    def __init__(self, item_keys=()):
+        """
+        :param item_keys: top-level keys whose array elements are reported one by one
+        """
+        self.item_keys = set(item_keys)
+        self._text = ""
+        self._stack = []
+        self._in_string = False
+        self._escape = False
+        self._token_start = None
+        self._done = False
+
+    def feed(self, chunk):
+        """
+        Parses the next piece of text
+
+        :param chunk: text following the previous pieces
+        :return: list of ("section", key, value) and ("item", key, value) events
+        """
+        events = []
+        start = len(self._text)
+        self._text += chunk
+        for index in range(start, len(self._text)):
+            char = self._text[index]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+                    self._end_string(index + 1, events)
+                continue
+            if self._token_start is not None and (char in ",}]" or char.isspace()):
+                self._complete(self._token_start, index, events)
+                self._token_start = None
+            if self._done or (not self._stack and char != "{") or char.isspace():
+                # text around the top-level object, e.g. a markdown fence, is skipped
+                continue
+            frame = self._stack[-1] if self._stack else None
+            if char == '"':
+                self._in_string = True
+                self._token_start = index
+            elif char in "{[":
+                key = frame["key"] if frame and frame["object"] else None
+                self._stack.append({"object": char == "{", "start": index,
+                                    "parent_key": key, "key": None, "expect_key": char == "{"})
+            elif char in "}]":
+                closed = self._stack.pop()
+                if self._stack:
+                    self._complete(closed["start"], index + 1, events)
+                else:
+                    self._done = True
+            elif char == ":":
+                frame["expect_key"] = False
+            elif char == ",":
+                frame["expect_key"] = frame["object"]
+            elif self._token_start is None:
+                self._token_start = index
+        return events
+
+    def result(self):
+        """
+        Returns the whole document once the top-level object is closed
+
+        :return: parsed JSON object
+        """
+        if not self._done:
+            raise LLMError("Completion ended before the JSON object was complete")
+        return parse_json_content(self._text)
+
+    def _end_string(self, end, events):
+        frame = self._stack[-1]
+        start, self._token_start = self._token_start, None
+        if frame["object"] and frame["expect_key"]:
+            frame["key"] = json.loads(self._text[start:end])
+        else:
+            self._complete(start, end, events)
+
+    def _complete(self, start, end, events):
+        depth = len(self._stack)
+        parent = self._stack[-1]
+        if depth == 1 and parent["key"] not in self.item_keys:
+            events.append(("section", parent["key"], self._load(start, end)))
+        elif depth == 2 and not parent["object"] and parent["parent_key"] in self.item_keys:
+            events.append(("item", parent["parent_key"], self._load(start, end)))
+
+    def _load(self, start, end):
+        try:
+            return json.loads(self._text[start:end])
+        except json.JSONDecodeError as err:
+            raise LLMError(f"Completion is not valid JSON: {err}")
+
+
+def fingerprint(url, payload):
+    """
+    Returns a key identifying a completion request
+
+    :param url: endpoint the request is sent to
+    :param payload: request body
+    :return: hex encoded SHA-256 of the endpoint and the normalized body
+    """
+    normalized = json.dumps([url, payload], sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(normalized.encode()).hexdigest()
+
+
+def parse_json_content(content):
+    """
+    Parses the content of a completion, tolerating a markdown code fence around it
+
+    :param content: content string
+    :return: parsed JSON value
+    """
+    content = content.strip()
+    if content.startswith("```"):
+        content = content[3:]
+        if content.startswith("json"):
+            content = content[4:]
+        if content.endswith("```"):
+            content = content[:-3]
+    try:
+        return json.loads(content)
+    except json.JSONDecodeError as err:
+        raise LLMError(f"Completion is not valid JSON: {err}")
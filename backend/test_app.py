@@ -2,6 +2,9 @@
 Test module for the backend
 """
 import hashlib
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
 from io import BytesIO
 
 import pytest
@@ -10,7 +13,40 @@ import datetime
 from flask_mongoengine import MongoEngine
 from unittest.mock import patch, MagicMock
 import yaml
-from app import create_app, Users
+from authlib.integrations.flask_client import OAuth
+from authlib.jose import JsonWebKey, jwt
+from flask import Flask
+from llm_client import IncrementalJSONParser, LLMClient, LLMError, SingleFlight
+from app import (
+    create_app,
+    Users,
+    Applications,
+    AuthTokens,
+    TokenCache,
+    TokenDenyList,
+    SignedTokens,
+    migrate_auth_tokens,
+    get_new_user_id,
+    migrate_applications,
+    Analyses,
+    migrate_analyses,
+    Insights,
+    insights_key,
+    index_applications,
+    sync_indexes,
+    application_filter,
+    find_or_create_google_user,
+    OIDCMetadataCache,
+    PasswordHasher,
+    InsightCache,
+    CachedInsights,
+    MongoFlightStore,
+    CompletionFlights,
+    Counters,
+    Recommendations,
+    RecommendationJobs,
+    RecommendationWorker,
+)
 
 
 # Pytest fixtures are useful tools for calling resources
@@ -38,6 +74,9 @@ def client():
     db = MongoEngine()
     db.disconnect()
     db.init_app(app)
+    sync_indexes()
+    # tests run queued recommendation refreshes themselves, see RecommendationWorker.claim
+    app.recommendation_worker.workers = 0
     client = app.test_client()
     yield client
     db.disconnect()
@@ -55,14 +94,24 @@ def user(client):
     data = {"username": "testUser", "password": "test", "fullName": "fullName"}
 
     user = Users.objects(username=data["username"])
-    user.first()["applications"] = []
-    user.first().save()
+    set_applications(user.first(), [])
     rv = client.post("/users/login", json=data)
     jdata = json.loads(rv.data.decode("utf-8"))
     header = {"Authorization": "Bearer " + jdata["token"]}
     yield user.first(), header
-    user.first()["applications"] = []
-    user.first().save()
+    set_applications(user.first(), [])
+
+
+def set_applications(user, applications):
+    """
+    Replaces the applications stored for the user
+
+    :param user: the user object
+    :param applications: list of applications to store
+    """
+    Applications.objects(userId=user.id).delete()
+    for application in applications:
+        Applications._get_collection().insert_one({"userId": user.id, **application})
 
 
 # 1. testing if the flask app is running properly
@@ -97,8 +146,7 @@ def test_get_data(client, user):
     :param user: the test user object
     """
     user, header = user
-    user["applications"] = []
-    user.save()
+    set_applications(user, [])
     # without an application
     rv = client.get("/applications", headers=header)
     print(rv.data)
@@ -112,8 +160,7 @@ def test_get_data(client, user):
         "date": str(datetime.date(2021, 9, 23)),
         "status": "1",
     }
-    user["applications"] = [application]
-    user.save()
+    set_applications(user, [application])
     rv = client.get("/applications", headers=header)
     print(rv.data)
     assert rv.status_code == 200
@@ -134,8 +181,7 @@ def test_add_application(client, mocker, user):
         return_value=-1,
     )
     user, header = user
-    user["applications"] = []
-    user.save()
+    set_applications(user, [])
     # mocker.patch(
     #     # Dataset is in slow.py, but imported to main.py
     #     'app.Users.save'
@@ -173,8 +219,7 @@ def test_update_application(client, user):
         "date": str(datetime.date(2021, 9, 23)),
         "status": "1",
     }
-    user["applications"] = [application]
-    user.save()
+    set_applications(user, [application])
     new_application = {
         "id": 3,
         "jobTitle": "fakeJob12345",
@@ -207,8 +252,7 @@ def test_delete_application(client, user):
         "date": str(datetime.date(2021, 9, 23)),
         "status": "1",
     }
-    user["applications"] = [application]
-    user.save()
+    set_applications(user, [application])
 
     rv = client.delete("/applications/3", headers=auth)
     jdata = json.loads(rv.data.decode("utf-8"))["jobTitle"]
@@ -254,8 +298,7 @@ def test_resume(client, mocker, user):
         return_value=-1,
     )
     user, header = user
-    user["applications"] = []
-    user.save()
+    set_applications(user, [])
     data = dict(
         file=(BytesIO(b"testing resume"), "resume.txt"),
     )
@@ -581,3 +624,1161 @@ def test_serve_profile_photo_user_not_found(mock_user_objects, client):
 
     response = client.get('/profilePhoto/file', headers={'Authorization': 'Bearer token'})
     assert response.status_code == 401
+
+
+def test_token_cache_hit_and_miss():
+    """
+    Tests that the token cache counts hits and misses
+    """
+    cache = TokenCache(max_size=10, ttl=60)
+    assert cache.get("1.abc") is None
+    cache.set("1.abc", "1", datetime.datetime.utcnow() + datetime.timedelta(days=1))
+    assert cache.get("1.abc") == "1"
+    assert cache.stats() == {"size": 1, "hits": 1, "misses": 1}
+
+
+def test_token_cache_expiry_and_invalidation():
+    """
+    Tests that expired or invalidated tokens are not served from the cache
+    """
+    cache = TokenCache(max_size=10, ttl=60)
+    cache.set("1.old", "1", datetime.datetime.utcnow() - datetime.timedelta(seconds=1))
+    assert cache.get("1.old") is None
+    cache.set("1.abc", "1", datetime.datetime.utcnow() + datetime.timedelta(days=1))
+    cache.invalidate("1.abc")
+    assert cache.get("1.abc") is None
+
+
+def test_token_cache_is_bounded():
+    """
+    Tests that the least recently used token is evicted when the cache is full
+    """
+    cache = TokenCache(max_size=2, ttl=60)
+    expiry = datetime.datetime.utcnow() + datetime.timedelta(days=1)
+    cache.set("1.a", "1", expiry)
+    cache.set("2.b", "2", expiry)
+    cache.get("1.a")
+    cache.set("3.c", "3", expiry)
+    assert cache.get("2.b") is None
+    assert cache.get("1.a") == "1"
+
+
+def test_logout_invalidates_cached_token(client, user):
+    """
+    Tests that a logged out token is no longer accepted from the cache
+
+    :param client: mongodb client
+    :param user: the test user object
+    """
+    user, header = user
+    assert client.get("/applications", headers=header).status_code == 200
+    client.post("/users/logout", headers=header)
+    rv = client.get("/applications", headers=header)
+    assert rv.status_code == 401
+
+
+def test_login_stores_token_in_collection(client, user):
+    """
+    Tests that login stores its token as an AuthTokens document and logout deletes it
+
+    :param client: mongodb client
+    :param user: the test user object
+    """
+    user, header = user
+    token = header["Authorization"].split(" ")[1]
+    assert AuthTokens.objects(token=token).first().userId == user.id
+    client.post("/users/logout", headers=header)
+    assert AuthTokens.objects(token=token).first() is None
+
+
+def test_token_with_foreign_user_prefix_is_rejected(client, user):
+    """
+    Tests that a valid token cannot be replayed with another user's id as prefix
+
+    :param client: mongodb client
+    :param user: the test user object
+    """
+    user, header = user
+    token = header["Authorization"].split(" ")[1]
+    forged = str(user.id + 1) + "." + token.split(".", 1)[1]
+    rv = client.get("/applications", headers={"Authorization": "Bearer " + forged})
+    assert rv.status_code == 401
+
+
+def test_migrate_auth_tokens(client, user):
+    """
+    Tests that embedded tokens are moved to the AuthTokens collection
+
+    :param client: mongodb client
+    :param user: the test user object
+    """
+    user, _ = user
+    expiry = datetime.datetime.now() + datetime.timedelta(hours=1)
+    expired = datetime.datetime.now() - datetime.timedelta(hours=1)
+    user.update(authTokens=[
+        {"token": f"{user.id}.migrated", "expiry": expiry.strftime("%m/%d/%Y, %H:%M:%S")},
+        {"token": f"{user.id}.expired", "expiry": expired.strftime("%m/%d/%Y, %H:%M:%S")},
+    ])
+    assert migrate_auth_tokens() >= 1
+    assert AuthTokens.objects(token=f"{user.id}.migrated").first().userId == user.id
+    assert AuthTokens.objects(token=f"{user.id}.expired").first() is None
+    assert not Users.objects(id=user.id).first().authTokens
+    AuthTokens.objects(token=f"{user.id}.migrated").delete()
+
+
+def test_signed_token_round_trip():
+    """
+    Tests that a signed token verifies to its user id and rejects tampering
+    """
+    signer = SignedTokens("secret", TokenDenyList(shared=False))
+    token, _ = signer.issue(42)
+    assert signer.verify(token) == "42"
+    user_id, expires, signature = token.split(".")
+    assert signer.verify(f"43.{expires}.{signature}") is None
+    assert signer.verify(f"{user_id}.{int(expires) + 1}.{signature}") is None
+    assert SignedTokens("other", TokenDenyList(shared=False)).verify(token) is None
+
+
+def test_signed_token_expiry_and_revocation():
+    """
+    Tests that expired and revoked signed tokens are rejected
+    """
+    expired = SignedTokens(
+        "secret", TokenDenyList(shared=False), lifetime=datetime.timedelta(seconds=-1)
+    )
+    token, _ = expired.issue(42)
+    assert expired.verify(token) is None
+
+    signer = SignedTokens("secret", TokenDenyList(shared=False))
+    token, _ = signer.issue(42)
+    signer.revoke(token)
+    assert signer.verify(token) is None
+
+
+def test_get_new_user_id_is_sequential(client):
+    """
+    Tests that new user ids are handed out in order and above every existing id
+
+    :param client: mongodb client
+    """
+    first = get_new_user_id()
+    second = get_new_user_id()
+    assert second == first + 1
+    assert first > Users.objects.order_by("-id").first().id
+
+
+def test_add_application_ids_are_sequential(client, user):
+    """
+    Tests that consecutive applications get increasing ids from the user's sequence
+
+    :param client: mongodb client
+    :param user: the test user object
+    """
+    user, header = user
+    set_applications(user, [])
+    user.update(applicationSeq=7)
+    application = {"jobTitle": "fakeJob12345", "companyName": "fakeCompany"}
+    first = client.post("/applications", headers=header, json={"application": application})
+    second = client.post("/applications", headers=header, json={"application": application})
+    assert json.loads(first.data)["id"] == 8
+    assert json.loads(second.data)["id"] == 9
+    assert [a["id"] for a in json.loads(client.get("/applications", headers=header).data)] == [8, 9]
+
+
+def test_update_application_only_changes_target(client, user):
+    """
+    Tests that updating one application leaves the others untouched
+
+    :param client: mongodb client
+    :param user: the test user object
+    """
+    user, auth = user
+    applications = [
+        {"id": 3, "jobTitle": "keep", "companyName": "keep", "status": "1"},
+        {"id": 4, "jobTitle": "edit", "companyName": "edit", "status": "1"},
+    ]
+    set_applications(user, applications)
+    rv = client.put("/applications/4", json={"application": {"status": "2"}}, headers=auth)
+    assert rv.status_code == 200
+    assert json.loads(rv.data) == {**applications[1], "status": "2"}
+    rv = client.get("/applications", headers=auth)
+    assert json.loads(rv.data) == [applications[0], {**applications[1], "status": "2"}]
+
+
+def test_update_and_delete_missing_application(client, user):
+    """
+    Tests that updating or deleting an unknown application returns an error
+
+    :param client: mongodb client
+    :param user: the test user object
+    """
+    user, auth = user
+    set_applications(user, [])
+    rv = client.put("/applications/99", json={"application": {"status": "2"}}, headers=auth)
+    assert rv.status_code == 400
+    rv = client.delete("/applications/99", headers=auth)
+    assert rv.status_code == 400
+
+
+def test_get_data_pagination(client, user):
+    """
+    Tests that GET /applications pages through applications with a cursor
+
+    :param client: mongodb client
+    :param user: the test user object
+    """
+    user, header = user
+    applications = [
+        {"id": i, "jobTitle": f"job{i}", "companyName": "c", "date": f"2021-09-{30 - i:02d}"}
+        for i in range(1, 6)
+    ]
+    set_applications(user, applications)
+
+    rv = client.get("/applications?limit=2", headers=header)
+    page = json.loads(rv.data)
+    assert [a["id"] for a in page["applications"]] == [1, 2]
+    rv = client.get(f"/applications?limit=2&after={page['next']}", headers=header)
+    page = json.loads(rv.data)
+    assert [a["id"] for a in page["applications"]] == [3, 4]
+    rv = client.get(f"/applications?limit=2&after={page['next']}", headers=header)
+    page = json.loads(rv.data)
+    assert [a["id"] for a in page["applications"]] == [5]
+    assert page["next"] is None
+
+    rv = client.get("/applications?limit=3&sort=date", headers=header)
+    assert [a["id"] for a in json.loads(rv.data)["applications"]] == [5, 4, 3]
+    rv = client.get("/applications?sort=password", headers=header)
+    assert rv.status_code == 400
+
+
+def test_migrate_applications(client, user):
+    """
+    Tests that embedded applications are moved to the Applications collection
+
+    :param client: mongodb client
+    :param user: the test user object
+    """
+    user, header = user
+    user.update(
+        applications=[{"id": 4, "jobTitle": "a", "companyName": "b"}],
+        unset__applicationSeq=True,
+    )
+    assert migrate_applications() >= 1
+    assert Users.objects(id=user.id).first().applicationSeq == 4
+    rv = client.get("/applications", headers=header)
+    assert json.loads(rv.data) == [{"id": 4, "jobTitle": "a", "companyName": "b"}]
+
+
+def test_get_data_filters_and_fields(client, user):
+    """
+    Tests filtering GET /applications by status, company prefix, date and fields
+
+    :param client: mongodb client
+    :param user: the test user object
+    """
+    user, header = user
+    set_applications(user, [
+        {"id": 1, "jobTitle": "a", "companyName": "Google", "date": "2021-09-01", "status": "1"},
+        {"id": 2, "jobTitle": "b", "companyName": "Goldman", "date": "2021-10-01", "status": "2"},
+        {"id": 3, "jobTitle": "c", "companyName": "Meta", "date": "2021-11-01", "status": "2"},
+    ])
+
+    def ids(query):
+        rv = client.get("/applications?" + query, headers=header)
+        return [a["id"] for a in json.loads(rv.data)]
+
+    assert ids("status=2") == [2, 3]
+    assert ids("status=1,2&companyName=Go") == [1, 2]
+    assert ids("dateFrom=2021-10-01&dateTo=2021-12-31") == [2, 3]
+    rv = client.get("/applications?status=1&fields=id,jobTitle", headers=header)
+    assert json.loads(rv.data) == [{"id": 1, "jobTitle": "a"}]
+    rv = client.get("/applications?fields=$where", headers=header)
+    assert rv.status_code == 400
+
+
+def test_application_dates_are_normalized(client, user):
+    """
+    Tests that dates are zero padded when written, so that date ranges and
+    sorting compare them correctly, and that invalid dates are rejected
+
+    :param client: mongodb client
+    :param user: the test user object
+    """
+    user, header = user
+    set_applications(user, [])
+    rv = client.post("/applications", headers=header,
+                     json={"application": {"jobTitle": "a", "companyName": "b", "date": "2021-9-22"}})
+    assert json.loads(rv.data)["date"] == "2021-09-22"
+    application_id = json.loads(rv.data)["id"]
+    rv = client.put(f"/applications/{application_id}", headers=header,
+                    json={"application": {"date": "2021-10-1"}})
+    assert json.loads(rv.data)["date"] == "2021-10-01"
+    rv = client.get("/applications?dateFrom=2021-09-30&dateTo=2021-10-01", headers=header)
+    assert [a["id"] for a in json.loads(rv.data)] == [application_id]
+
+    rv = client.post("/applications", headers=header,
+                     json={"application": {"jobTitle": "a", "companyName": "b", "date": "22/09/2021"}})
+    assert rv.status_code == 400
+    rv = client.get("/applications?dateFrom=2021-9-1", headers=header)
+    assert rv.status_code == 400
+
+
+def test_import_applications_csv(client, user):
+    """
+    Tests that the example CSV can be bulk imported with per-row errors
+
+    :param client: mongodb client
+    :param user: the test user object
+    """
+    user, header = user
+    with open("data/applications.csv", "rb") as f:
+        content = f.read() + b",Missing Title,2021-09-22,1,99\nTitle,Bad Date,22/09/2021,1,100\n"
+    rv = client.post(
+        "/applications/import",
+        headers=header,
+        content_type="multipart/form-data",
+        data={"file": (BytesIO(content), "applications.csv")},
+    )
+    assert rv.status_code == 200
+    result = json.loads(rv.data)
+    assert result["imported"] == len(content.splitlines()) - 3
+    assert result["errors"][-2]["error"] == "Missing fields in input"
+    assert result["errors"][-1]["error"] == "Invalid date, expected YYYY-MM-DD"
+    rv = client.get("/applications", headers=header)
+    assert json.loads(rv.data)[0]["companyName"] == "Facebook"
+    # written as 2021-9-22 in the file
+    assert json.loads(rv.data)[0]["date"] == "2021-09-22"
+
+
+def test_import_applications_ndjson(client, user):
+    """
+    Tests that NDJSON rows are imported and invalid lines are reported
+
+    :param client: mongodb client
+    :param user: the test user object
+    """
+    user, header = user
+    content = b'{"jobTitle": "a", "companyName": "b", "status": "2"}\nnot json\n'
+    rv = client.post(
+        "/applications/import",
+        headers=header,
+        content_type="multipart/form-data",
+        data={"file": (BytesIO(content), "applications.ndjson")},
+    )
+    result = json.loads(rv.data)
+    assert result["imported"] == 1
+    assert result["errors"][0]["row"] == 2
+
+
+def test_import_applications_bad_encoding(client, user):
+    """
+    Tests that a file that is not UTF-8 encoded is rejected with a 400
+
+    :param client: mongodb client
+    :param user: the test user object
+    """
+    user, header = user
+    content = "jobTitle,companyName\nIngénieur,Société\n".encode("latin-1")
+    rv = client.post(
+        "/applications/import",
+        headers=header,
+        content_type="multipart/form-data",
+        data={"file": (BytesIO(content), "applications.csv")},
+    )
+    assert rv.status_code == 400
+    assert "UTF-8" in json.loads(rv.data)["error"]
+
+
+def test_export_applications(client, user):
+    """
+    Tests that applications export in the column layout of the example CSV
+
+    :param client: mongodb client
+    :param user: the test user object
+    """
+    user, header = user
+    set_applications(user, [
+        {"id": 1, "jobTitle": "a", "companyName": "b", "date": "2021-09-22", "status": "2"},
+    ])
+    rv = client.get("/applications/export", headers=header)
+    assert rv.status_code == 200
+    with open("data/applications.csv") as f:
+        header_row = f.readline().strip()
+    assert rv.data.decode("utf-8").splitlines() == [header_row, "a,b,2021-09-22,2,1"]
+
+    rv = client.get("/applications/export?format=ndjson", headers=header)
+    assert json.loads(rv.data.decode("utf-8").splitlines()[0])["jobTitle"] == "a"
+
+
+def test_export_analyses(client, user):
+    """
+    Tests that saved analyses are exported as NDJSON
+
+    :param client: mongodb client
+    :param user: the test user object
+    """
+    user, header = user
+    analysis = {"id": 1, "searchTerm": "x", "date": "d", "comparison": {}, "insights": {}}
+    client.post("/analyses", headers=header, json=analysis)
+    rv = client.get("/analyses/export?format=ndjson", headers=header)
+    assert rv.status_code == 200
+    exported = json.loads(rv.data.decode("utf-8").splitlines()[-1])
+    exported.pop("createdAt")
+    assert exported == analysis
+
+
+def test_query_counts(client, user):
+    """
+    Tests the number of database round-trips made by hot handlers
+
+    :param client: mongodb client
+    :param user: the test user object
+    """
+    user, header = user
+    client.application.config["EXPOSE_QUERY_COUNT"] = True
+    rv = client.get("/getProfile", headers=header)
+    assert rv.headers["X-Query-Count"] == "1"
+
+    # the first request validates the token, later ones are served from the token cache
+    client.get("/applications", headers=header)
+    rv = client.post(
+        "/applications",
+        headers=header,
+        json={"application": {"jobTitle": "fakeJob12345", "companyName": "fakeCompany"}},
+    )
+    assert rv.headers["X-Query-Count"] == "2"
+
+
+def test_update_profile_partial(client, user):
+    """
+    Tests that /updateProfile writes only the given profile fields
+
+    :param client: mongodb client
+    :param user: the test user object
+    """
+    user, header = user
+    skills = [{"label": "Python", "value": "Python"}]
+    rv = client.post(
+        "/updateProfile",
+        headers=header,
+        json={"id": user.id, "username": user.username, "skills": skills},
+    )
+    assert rv.status_code == 200
+    assert json.loads(rv.data)["skills"] == skills
+    assert json.loads(rv.data)["fullName"] == user.fullName
+    assert Users.objects(id=user.id).first().skills == skills
+    assert RecommendationJobs.objects(userId=user.id).get().status == "queued"
+    RecommendationJobs.objects(userId=user.id).delete()
+
+
+def test_update_profile_rejects_invalid_fields(client, user):
+    """
+    Tests that /updateProfile rejects unknown fields and malformed values
+
+    :param client: mongodb client
+    :param user: the test user object
+    """
+    user, header = user
+    rv = client.post("/updateProfile", headers=header, json={"password": "x"})
+    assert rv.status_code == 400
+    rv = client.post("/updateProfile", headers=header, json={"skills": ["Python"]})
+    assert rv.status_code == 400
+    rv = client.post("/updateProfile", headers=header, json={"fullName": 5})
+    assert rv.status_code == 400
+
+
+def test_get_analyses_pagination_and_summary(client, user):
+    """
+    Tests that analyses are paged newest first and summaries omit the insights
+
+    :param client: mongodb client
+    :param user: the test user object
+    """
+    user, header = user
+    Analyses.objects(userId=user.id).delete()
+    for i in range(3):
+        client.post("/analyses", headers=header, json={
+            "id": i, "searchTerm": f"role{i}", "comparison": {}, "insights": {"x": i}})
+
+    rv = client.get("/analyses", headers=header)
+    assert [a["id"] for a in json.loads(rv.data)] == [0, 1, 2]
+    rv = client.get("/analyses?limit=2&summary=1", headers=header)
+    page = json.loads(rv.data)
+    assert [a["id"] for a in page["analyses"]] == [2, 1]
+    assert "insights" not in page["analyses"][0]
+    rv = client.get(f"/analyses?limit=2&after={page['next']}", headers=header)
+    page = json.loads(rv.data)
+    assert [a["id"] for a in page["analyses"]] == [0]
+    assert page["next"] is None
+    Analyses.objects(userId=user.id).delete()
+
+
+def test_migrate_analyses(client, user):
+    """
+    Tests that embedded analyses are moved to the Analyses collection in order
+
+    :param client: mongodb client
+    :param user: the test user object
+    """
+    user, header = user
+    Analyses.objects(userId=user.id).delete()
+    user.update(analyses=[{"id": 1, "searchTerm": "a"}, {"id": 2, "searchTerm": "b"}])
+    assert migrate_analyses() >= 2
+    rv = client.get("/analyses", headers=header)
+    assert [a["id"] for a in json.loads(rv.data)] == [1, 2]
+    assert not Users.objects(id=user.id).first().analyses
+    Analyses.objects(userId=user.id).delete()
+
+
+def test_analyses_share_insights(client, user):
+    """
+    Tests that identical insights are stored once and re-hydrated on read
+
+    :param client: mongodb client
+    :param user: the test user object
+    """
+    user, header = user
+    Analyses.objects(userId=user.id).delete()
+    insights = {"roleOverview": "x", "softSkills": ["a", "b"]}
+    for i in range(2):
+        client.post("/analyses", headers=header, json={
+            "id": i, "searchTerm": "role", "comparison": {"overallMatch": i},
+            "insights": dict(reversed(list(insights.items())))})
+
+    stored = Analyses._get_collection().find({"userId": user.id})
+    assert {a["insightsRef"] for a in stored} == {insights_key(insights)}
+    assert Insights.objects(key=insights_key(insights)).count() == 1
+    rv = client.get("/analyses", headers=header)
+    assert [a["insights"] for a in json.loads(rv.data)] == [insights, insights]
+    Analyses.objects(userId=user.id).delete()
+
+
+def test_application_stats(client, user):
+    """
+    Tests that /applications/stats summarizes the user's applications
+
+    :param client: mongodb client
+    :param user: the test user object
+    """
+    user, header = user
+    set_applications(user, [
+        {"id": 1, "jobTitle": "a", "companyName": "Acme", "date": "2023-10-02", "status": "1"},
+        {"id": 2, "jobTitle": "b", "companyName": "Acme", "date": "2023-10-04", "status": "3"},
+        {"id": 3, "jobTitle": "c", "companyName": "Initech", "date": "2023-10-10", "status": "3"},
+        {"id": 4, "jobTitle": "d", "companyName": "", "date": "", "status": "4"},
+        {"id": 5, "jobTitle": "e", "companyName": "", "status": 3},
+        {"id": 6, "jobTitle": "f", "companyName": "", "status": None},
+    ])
+    rv = client.get("/applications/stats?top=1", headers=header)
+    assert rv.status_code == 200
+    assert json.loads(rv.data) == {
+        "total": 6,
+        "byStatus": {"1": 1, "3": 3, "4": 1, "unknown": 1},
+        "byWeek": [{"week": "2023-W40", "count": 2}, {"week": "2023-W41", "count": 1}],
+        "topCompanies": [{"companyName": "Acme", "count": 2}],
+    }
+    rv = client.get("/applications/stats?top=x", headers=header)
+    assert rv.status_code == 400
+
+
+def test_application_stats_unpadded_dates(client, user):
+    """
+    Tests that /applications/stats counts dates written without zero padding,
+    as in data/applications.csv
+
+    :param client: mongodb client
+    :param user: the test user object
+    """
+    user, header = user
+    set_applications(user, [
+        {"id": 1, "jobTitle": "a", "companyName": "Acme", "date": "2021-9-22", "status": "1"},
+        {"id": 2, "jobTitle": "b", "companyName": "Acme", "date": "2021-09-23", "status": "1"},
+        {"id": 3, "jobTitle": "c", "companyName": "Acme", "date": "2021-10-1", "status": "1"},
+    ])
+    rv = client.get("/applications/stats", headers=header)
+    assert rv.status_code == 200
+    assert json.loads(rv.data)["byWeek"] == [
+        {"week": "2021-W38", "count": 2}, {"week": "2021-W39", "count": 1}]
+
+
+def test_search_applications(client, user):
+    """
+    Tests prefix search and ranking on /applications/search
+
+    :param client: mongodb client
+    :param user: the test user object
+    """
+    user, header = user
+    set_applications(user, [
+        {"id": 1, "jobTitle": "Data Analyst", "companyName": "Softbank", "location": "Raleigh"},
+        {"id": 2, "jobTitle": "Software Engineer", "companyName": "Acme", "location": "Durham"},
+        {"id": 3, "jobTitle": "Engineer", "companyName": "Soft", "location": "Cary"},
+    ])
+    assert index_applications() == 3
+
+    rv = client.get("/applications/search?q=soft", headers=header)
+    assert rv.status_code == 200
+    applications = json.loads(rv.data)["applications"]
+    assert [a["id"] for a in applications] == [3, 2, 1]
+    assert "searchTerms" not in applications[0]
+
+    rv = client.get("/applications/search?q=soft%20eng", headers=header)
+    assert [a["id"] for a in json.loads(rv.data)["applications"]] == [3, 2]
+
+    client.put("/applications/1", headers=header,
+               json={"application": {"location": "Engelberg"}})
+    rv = client.get("/applications/search?q=eng&limit=5", headers=header)
+    assert [a["id"] for a in json.loads(rv.data)["applications"]] == [3, 2, 1]
+
+    rv = client.get("/applications/search?q=%20", headers=header)
+    assert rv.status_code == 400
+
+
+def plan_stages(plan):
+    """
+    Returns every stage of a query plan
+
+    :param plan: winning plan from explain
+    :return: list of stage names
+    """
+    stages = [plan.get("stage")]
+    for key in ("inputStage", "queryPlan"):
+        if key in plan:
+            stages += plan_stages(plan[key])
+    for child in plan.get("inputStages", []):
+        stages += plan_stages(child)
+    return stages
+
+
+def test_hot_queries_use_indexes(client, user):
+    """
+    Tests that the queries of the hot handlers do not scan whole collections
+
+    :param client: mongodb client
+    :param user: the test user object
+    """
+    user, _ = user
+    queries = [
+        (Users, {"username": "testUser"}),
+        (Users, {"email": "test@example.com"}),
+        (AuthTokens, {"token": "%d.token" % user.id}),
+        (Applications, {"userId": user.id, "id": 1}),
+        (Applications, application_filter(user.id, {"status": "1,2"})),
+        (Applications, application_filter(user.id, {"companyName": "Ac"})),
+        (Applications, {"userId": user.id, "$and": [{"searchTerms": {"$regex": "^so"}}]}),
+        (Analyses, {"userId": user.id}),
+    ]
+    for model, query in queries:
+        plan = model._get_collection().find(query).explain()["queryPlanner"]["winningPlan"]
+        assert "COLLSCAN" not in plan_stages(plan), (model.__name__, query)
+
+
+def test_find_or_create_google_user(client):
+    """
+    Tests that a Google sign-in creates the user once and then finds it by email
+
+    :param client: mongodb client
+    """
+    email = "google.user@example.com"
+    Users.objects(email=email).delete()
+    user_id = find_or_create_google_user(email, "Google User")
+    assert find_or_create_google_user(email, "Renamed") == user_id
+    # returning users do not use up an id
+    assert Counters._get_collection().find_one({"_id": "users"})["seq"] == user_id
+
+    user = Users.objects(email=email).get()
+    assert user.id == user_id
+    assert user.fullName == "Google User"
+    assert user.skills == []
+    user.delete()
+
+
+@pytest.fixture
+def oidc_provider():
+    """
+    Serves a stand-in OpenID provider on localhost that publishes one RSA key
+    and counts the requests made to it
+
+    :return: base URL, private key and request counts of the provider
+    """
+    key = JsonWebKey.generate_key("RSA", 2048, is_private=True, options={"kid": "test"})
+    hits = {"/.well-known/openid-configuration": 0, "/jwks": 0}
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            hits[self.path] += 1
+            if self.path == "/jwks":
+                body = {"keys": [key.as_dict()]}
+            else:
+                body = {"issuer": base_url, "jwks_uri": base_url + "/jwks"}
+            data = json.dumps(body).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(("127.0.0.1", 0), Handler)
+    base_url = "http://127.0.0.1:%d" % server.server_port
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield base_url, key, hits
+    server.shutdown()
+
+
+def test_oidc_metadata_cache(oidc_provider):
+    """
+    Tests that ID tokens are verified against cached provider metadata and that
+    the metadata is reloaded once its TTL has passed
+
+    :param oidc_provider: the stand-in OpenID provider
+    """
+    base_url, key, hits = oidc_provider
+    oauth = OAuth(Flask(__name__))
+    client = oauth.register(
+        name="google",
+        client_id="client",
+        client_secret="secret",
+        server_metadata_url=base_url + "/.well-known/openid-configuration",
+    )
+    cache = OIDCMetadataCache(client._server_metadata_url, ttl=60, refresh_interval=30)
+    now = int(time.time())
+    claims = {"iss": base_url, "aud": "client", "sub": "1", "email": "a@b.c",
+              "nonce": "n", "iat": now, "exp": now + 60}
+    id_token = jwt.encode({"alg": "RS256", "kid": "test"}, claims, key).decode()
+
+    for _ in range(3):
+        user = cache.apply(client).parse_id_token(
+            {"id_token": id_token, "access_token": "a"}, nonce="n")
+        assert user["email"] == "a@b.c"
+    assert hits == {"/.well-known/openid-configuration": 1, "/jwks": 1}
+
+    cache.ttl = 0
+    cache.apply(client)
+    assert hits == {"/.well-known/openid-configuration": 2, "/jwks": 2}
+
+
+def test_password_hasher():
+    """
+    Tests scrypt hashing, legacy MD5 verification and rehash detection
+    """
+    hasher = PasswordHasher(n=2 ** 10, workers=1)
+    stored = hasher.hash("secret")
+    assert stored.startswith("scrypt$1024$8$1$")
+    assert stored != hasher.hash("secret")
+    assert hasher.verify("secret", stored)
+    assert not hasher.verify("wrong", stored)
+    assert not hasher.needs_rehash(stored)
+
+    legacy = hashlib.md5(b"secret").hexdigest()
+    assert hasher.verify("secret", legacy)
+    assert not hasher.verify("wrong", legacy)
+    assert hasher.needs_rehash(legacy)
+    assert PasswordHasher(n=2 ** 11).needs_rehash(stored)
+
+
+def test_password_hasher_timeout():
+    """
+    Tests that a hash that takes too long raises the builtin TimeoutError and
+    keeps its pool slot until it is done, so no hash is left queued behind it
+    """
+    hasher = PasswordHasher(n=2 ** 16, workers=1, max_pending=0, timeout=0.01)
+    with pytest.raises(TimeoutError):
+        hasher.hash("secret")
+    with pytest.raises(TimeoutError):
+        hasher.hash("secret")
+    assert hasher._pool._work_queue.qsize() == 0
+
+
+def test_login_upgrades_md5_password(client, user):
+    """
+    Tests that logging in with an MD5 password stores a scrypt hash instead
+
+    :param client: mongodb client
+    :param user: the test user object
+    """
+    user, _ = user
+    user.update(password=hashlib.md5(b"test").hexdigest())
+    data = {"username": "testUser", "password": "test"}
+
+    rv = client.post("/users/login", json=data)
+    assert rv.status_code == 200
+    user.reload()
+    assert user.password.startswith("scrypt$")
+
+    rv = client.post("/users/login", json=data)
+    assert rv.status_code == 200
+    rv = client.post("/users/login", json={"username": "testUser", "password": "x"})
+    assert rv.status_code == 400
+
+
+@pytest.fixture
+def completion_stub():
+    """
+    Serves a stand-in chat completion API on localhost. Each request gets the
+    next queued (status, content) answer, the last one being repeated.
+    Streaming requests get the content as Server-Sent Events, 8 characters at a time
+
+    :return: endpoint URL, answer queue and list of received payloads
+    """
+    answers = [(200, "{}")]
+    received = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            received.append(json.loads(self.rfile.read(int(self.headers["Content-Length"]))))
+            status, content = answers.pop(0) if len(answers) > 1 else answers[0]
+            if status == 200 and received[-1].get("stream"):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.end_headers()
+                for i in range(0, len(content), 8):
+                    chunk = {"choices": [{"delta": {"content": content[i:i + 8]}}]}
+                    self.wfile.write(b"data: " + json.dumps(chunk).encode() + b"\n\n")
+                self.wfile.write(b"data: [DONE]\n\n")
+                return
+            body = {"choices": [{"message": {"content": content}}]} if status == 200 else {}
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield "http://127.0.0.1:%d/v1/chat/completions" % server.server_port, answers, received
+    server.shutdown()
+
+
+def test_llm_client_retries(completion_stub):
+    """
+    Tests JSON parsing and the bounded retries of the LLM client
+
+    :param completion_stub: the stand-in completion API
+    """
+    url, answers, received = completion_stub
+    llm = LLMClient(url=url, backoff=0, max_retries=2)
+
+    answers[:] = [(429, ""), (503, ""), (200, '```json\n{"a": 1}\n```')]
+    assert llm.complete_json("system", "prompt") == {"a": 1}
+    assert len(received) == 3
+    assert received[0]["response_format"] == {"type": "json_object"}
+
+    received.clear()
+    answers[:] = [(500, "")]
+    with pytest.raises(LLMError):
+        llm.complete_json("system", "prompt")
+    assert len(received) == 3
+
+    received.clear()
+    answers[:] = [(400, "")]
+    with pytest.raises(LLMError):
+        llm.complete_json("system", "prompt")
+    assert len(received) == 1
+
+    answers[:] = [(200, "not json")]
+    with pytest.raises(LLMError):
+        llm.complete_json("system", "prompt")
+
+
+def test_search_uses_llm_client(client, completion_stub):
+    """
+    Tests that /search answers with the insights returned by the completion API
+
+    :param client: mongodb client
+    :param completion_stub: the stand-in completion API
+    """
+    url, answers, received = completion_stub
+    client.application.llm_client.url = url
+    answers[:] = [(200, '{"roleOverview": "Builds software"}')]
+    rv = client.get("/search?keywords=Software%20Engineer")
+    assert rv.status_code == 200
+    assert json.loads(rv.data) == {"roleOverview": "Builds software"}
+    assert "Software Engineer" in received[0]["messages"][1]["content"]
+
+
+def test_insight_cache(client):
+    """
+    Tests the memory and database tiers and the invalidation of the insight cache
+
+    :param client: mongodb client
+    """
+    CachedInsights.objects(keywords="data scientist").delete()
+    cache = InsightCache(max_size=1)
+    assert cache.get("Data Scientist", "model", "v1") is None
+    cache.set("Data Scientist", "model", "v1", {"roleOverview": "x"})
+
+    assert cache.get("  data   SCIENTIST", "model", "v1") == {"roleOverview": "x"}
+    assert cache.get("data scientist", "model", "v2") is None
+    # evicted from memory, still in the database
+    cache.set("other role", "model", "v1", {})
+    assert cache.get("data scientist", "model", "v1") == {"roleOverview": "x"}
+    assert cache.stats()["memoryHits"] == 1
+    assert cache.stats()["databaseHits"] == 1
+    assert cache.stats()["misses"] == 2
+    assert cache.stats()["hitRatio"] == 0.5
+
+    assert cache.invalidate("Data Scientist") == 1
+    assert cache.get("data scientist", "model", "v1") is None
+    cache.invalidate("other role")
+
+    # keywords containing ":" are only invalidated by an exact match
+    cache = InsightCache(shared=False)
+    cache.set("dev", "model", "v1", {"roleOverview": "dev"})
+    cache.set("qa:dev", "model", "v1", {"roleOverview": "qa"})
+    cache.invalidate("dev")
+    assert cache.get("dev", "model", "v1") is None
+    assert cache.get("qa:dev", "model", "v1") == {"roleOverview": "qa"}
+
+
+def test_search_is_cached(client, completion_stub):
+    """
+    Tests that a repeated /search does not call the completion API again
+
+    :param client: mongodb client
+    :param completion_stub: the stand-in completion API
+    """
+    url, answers, received = completion_stub
+    client.application.llm_client.url = url
+    client.application.insight_cache.invalidate("Cached Role")
+    answers[:] = [(200, '{"roleOverview": "cached"}')]
+    for keywords in ("Cached Role", "cached  role"):
+        rv = client.get("/search", query_string={"keywords": keywords})
+        assert json.loads(rv.data) == {"roleOverview": "cached"}
+    assert len(received) == 1
+    client.application.insight_cache.invalidate("Cached Role")
+
+
+def test_single_flight():
+    """
+    Tests that concurrent calls with the same key share one call, its result and its error
+    """
+    flight = SingleFlight()
+    calls = []
+
+    def call(outcome):
+        calls.append(outcome)
+        deadline = time.time() + 5
+        while flight.coalesced < 4 and time.time() < deadline:
+            time.sleep(0.01)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    for outcome in ("result", LLMError("failed")):
+        results = []
+
+        def run():
+            try:
+                results.append(flight.do("key", lambda: call(outcome)))
+            except LLMError as err:
+                results.append(err)
+
+        flight.coalesced = 0
+        threads = [threading.Thread(target=run) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert results == [outcome] * 5
+    assert len(calls) == 2
+
+
+def test_single_flight_across_workers(client):
+    """
+    Tests that a worker waits for and shares the result published by another worker
+
+    :param client: mongodb client
+    """
+    CompletionFlights.objects(key="shared-key").delete()
+    first = SingleFlight(store=MongoFlightStore(poll_interval=0.01))
+    second = SingleFlight(store=MongoFlightStore(poll_interval=0.01))
+    calls = []
+    waiting = threading.Event()
+    results = []
+
+    def slow_call():
+        calls.append(1)
+        waiting.wait(5)
+        time.sleep(0.1)
+        return "result"
+
+    thread = threading.Thread(target=lambda: results.append(first.do("shared-key", slow_call)))
+    thread.start()
+    while not CompletionFlights.objects(key="shared-key").count():
+        time.sleep(0.01)
+    waiting.set()
+    results.append(second.do("shared-key", lambda: calls.append(2) or "other"))
+    thread.join()
+    assert results == ["result", "result"]
+    assert calls == [1]
+    CompletionFlights.objects(key="shared-key").delete()
+
+
+def test_single_flight_store_failure():
+    """
+    Tests that a failing flight store does not fail or discard the completion
+    """
+    class BrokenStore:
+        def claim(self, key):
+            raise ConnectionError("database down")
+
+        def publish(self, key, result=None, error=None):
+            raise ConnectionError("database down")
+
+    assert SingleFlight(store=BrokenStore()).do("key", lambda: "result") == "result"
+    BrokenStore.claim = lambda self, key: True
+    assert SingleFlight(store=BrokenStore()).do("key", lambda: "result") == "result"
+
+
+def parse_events(data):
+    """
+    Parses a Server-Sent Events body
+
+    :param data: response body
+    :return: list of (event, payload) tuples
+    """
+    events = []
+    for block in data.decode().split("\n\n"):
+        if block:
+            event, payload = block.split("\n")
+            events.append((event[len("event: "):], json.loads(payload[len("data: "):])))
+    return events
+
+
+def test_incremental_json_parser():
+    """
+    Tests that sections and items are reported as soon as they are complete
+    """
+    parser = IncrementalJSONParser(item_keys=("jobs",))
+    assert parser.feed('{"roleOverview": "a \\"b\\" }", "jobs": [{"x": 1}') == [
+        ("section", "roleOverview", 'a "b" }'),
+        ("item", "jobs", {"x": 1}),
+    ]
+    assert parser.feed(', {"y": "]"}], "n"') == [("item", "jobs", {"y": "]"})]
+    assert parser.feed(": 2}") == [("section", "n", 2)]
+    assert parser.result() == {"roleOverview": 'a "b" }', "jobs": [{"x": 1}, {"y": "]"}], "n": 2}
+
+    parser = IncrementalJSONParser()
+    parser.feed('{"a": [1')
+    with pytest.raises(LLMError):
+        parser.result()
+
+
+def test_search_stream(client, completion_stub):
+    """
+    Tests that /search?stream=1 streams the sections of the insights and then
+    the whole document, from the model and then from the cache
+
+    :param client: mongodb client
+    :param completion_stub: the stand-in completion API
+    """
+    url, answers, received = completion_stub
+    client.application.llm_client.url = url
+    client.application.insight_cache.invalidate("Streamed Role")
+    insights = {"roleOverview": "overview", "softSkills": ["a", "b"]}
+    answers[:] = [(200, json.dumps(insights))]
+
+    for _ in range(2):
+        rv = client.get("/search", query_string={"keywords": "Streamed Role", "stream": "1"})
+        assert rv.mimetype == "text/event-stream"
+        assert parse_events(rv.data) == [
+            ("section", {"key": "roleOverview", "value": "overview"}),
+            ("section", {"key": "softSkills", "value": ["a", "b"]}),
+            ("done", insights),
+        ]
+    assert len(received) == 1
+    assert received[0]["stream"] is True
+    client.application.insight_cache.invalidate("Streamed Role")
+
+
+def test_recommendations_stream(client, user, completion_stub):
+    """
+    Tests that /getRecommendations?stream=1 streams each job as it is generated
+
+    :param client: mongodb client
+    :param user: the test user object
+    :param completion_stub: the stand-in completion API
+    """
+    user, header = user
+    url, answers, _ = completion_stub
+    client.application.llm_client.url = url
+    job = {"Job Title": "t", "Company Name": "c", "Location": "l",
+           "Brief Job Description": "d", "Required Skills": "s",
+           "Experience Level": "e", "application URL": "u"}
+    answers[:] = [(200, json.dumps({"jobs": [job, {"broken": True}, job]}))]
+    rv = client.get("/getRecommendations?stream=1", headers=header)
+    events = parse_events(rv.data)
+    formatted = {"jobTitle": "t", "companyName": "c", "location": "l", "description": "d",
+                 "requiredSkills": "s", "experienceLevel": "e", "data_share_url": "u"}
+    assert events == [
+        ("item", {"key": "jobs", "value": formatted}),
+        ("item", {"key": "jobs", "value": formatted}),
+        ("done", {"jobs": [formatted, formatted]}),
+    ]
+
+
+def test_recommendations_precomputed(client, user, completion_stub):
+    """
+    Tests that a profile change refreshes the recommendations in the background
+    and that /getRecommendations then answers from the stored list
+
+    :param client: mongodb client
+    :param user: the test user object
+    :param completion_stub: the stand-in completion API
+    """
+    user, header = user
+    url, answers, received = completion_stub
+    client.application.llm_client.url = url
+    Recommendations.objects(userId=user.id).delete()
+    RecommendationJobs.objects(userId=user.id).delete()
+    job = {"Job Title": "t", "Company Name": "c", "Location": "l",
+           "Brief Job Description": "d", "Required Skills": "s",
+           "Experience Level": "e", "application URL": "u"}
+    answers[:] = [(200, json.dumps({"jobs": [job]}))]
+    rv = client.post("/updateProfile", headers=header,
+                     json={"skills": [{"label": "Python", "value": "Python"}]})
+    assert rv.status_code == 200
+    worker = client.application.recommendation_worker
+    worker.process(worker.claim(user.id))
+    stored = Recommendations._get_collection().find_one({"_id": user.id})
+    assert stored["jobs"][0]["jobTitle"] == "t"
+    assert RecommendationJobs._get_collection().find_one({"_id": user.id}) is None
+
+    calls = len(received)
+    rv = client.get("/getRecommendations", headers=header)
+    assert rv.status_code == 200
+    assert rv.headers["X-Recommendations-Stale"] == "false"
+    assert [job["jobTitle"] for job in json.loads(rv.data)] == ["t"]
+    assert len(received) == calls
+    Recommendations.objects(userId=user.id).delete()
+
+
+def test_recommendation_worker_marks_running_jobs_dirty(client):
+    """
+    Tests that a refresh requested while one is running is not run alongside it
+    but queued again once it ends
+
+    :param client: mongodb client
+    """
+    RecommendationJobs.objects(userId=-1).delete()
+    worker = RecommendationWorker(None, workers=0)
+    worker.enqueue(-1)
+    job = worker.claim(-1)
+    assert job["_id"] == -1
+
+    worker.enqueue(-1, force=True)
+    assert RecommendationJobs.objects(userId=-1).get().status == "running"
+    assert worker.claim(-1) is None
+
+    worker.process(job)
+    queued = RecommendationJobs.objects(userId=-1).get()
+    assert queued.status == "queued" and queued.force
+    worker.process(worker.claim(-1))
+    assert RecommendationJobs.objects(userId=-1).first() is None
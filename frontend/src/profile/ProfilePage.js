@@ -98,7 +98,7 @@ const ProfilePage = (props) => {
 
 		// Fetch applications and analyses
 		Promise.all([
-			fetch('http://127.0.0.1:5000/applications', {
+			fetch('http://127.0.0.1:5000/applications/stats', {
 				headers: {
 					'Authorization': 'Bearer ' + localStorage.getItem('token'),
 					'Access-Control-Allow-Origin': 'http://127.0.0.1:3000',
@@ -108,15 +108,15 @@ const ProfilePage = (props) => {
 			fetchProfilePhoto(),
 			fetchAnalyses()
 		])
-		.then(async ([applicationsResponse]) => {
-			const applicationsData = await applicationsResponse.json();
-			setApplicationCount(applicationsData.length);
-			// Count applications by status
+		.then(async ([statsResponse]) => {
+			const stats = await statsResponse.json();
+			setApplicationCount(stats.total);
+			// Counts by status are computed by the server
 			const counts = {
-				applied: applicationsData.filter(app => app.status === '3').length,
-				rejected: applicationsData.filter(app => app.status === '4').length,
-				waitingReferral: applicationsData.filter(app => app.status === '2').length,
-				wishList: applicationsData.filter(app => app.status === '1').length
+				applied: stats.byStatus['3'] || 0,
+				rejected: stats.byStatus['4'] || 0,
+				waitingReferral: stats.byStatus['2'] || 0,
+				wishList: stats.byStatus['1'] || 0
 			};
 			setApplicationsByStatus(counts);
 		})
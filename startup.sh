@@ -16,6 +16,8 @@ exit_result () {
 }
 echo -e "Navigating to backend..."
 cd ./backend || exit
+echo -e "Creating database indexes..."
+flask sync-indexes || echo -e "\033[0;31mIndexes: Failure, see the message above\033[0m"
 echo -e "Attempting to start backend..."
 flask run &
 exit_result $? "Backend boot"